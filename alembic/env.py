@@ -1,36 +1,30 @@
-"""Pylons bootstrap environment.
+"""Pyramid bootstrap environment.
 
-Place 'pylons_config_file' into alembic.ini, and the application will 
-be loaded from there.
+Place 'pylons_config_file' (and the app section as 'pylons_config_name')
+into alembic.ini, and the database url is read from the application
+settings there. The application itself is not
+loaded, so running migrations never triggers ``create_all``.
 
 """
+import os
+
 from alembic import context
-from paste.deploy import loadapp
+from paste.deploy import appconfig
 from logging.config import fileConfig
-from sqlalchemy.engine.base import Engine
-
+import sqlalchemy
 
-try:
-    # if pylons app already in, don't create a new app
-    from pylons import config as pylons_config
-    pylons_config['__file__']
-except:
-    config = context.config
-    # can use config['__file__'] here, i.e. the Pylons
-    # ini file, instead of alembic.ini
-    config_file = config.get_main_option('pylons_config_file')
-    fileConfig(config_file)
-    wsgi_app = loadapp('config:%s' % config_file, relative_to='.')
+from newtonian import models
+from newtonian import sqla
 
 
-# customize this section for non-standard engine configurations.
-meta = __import__("%s.model.meta" % wsgi_app.config['pylons.package']).model.meta
+config = context.config
+config_file = os.path.abspath(config.get_main_option('pylons_config_file'))
+fileConfig(config_file)
+settings = appconfig('config:%s' % config_file,
+                     name=config.get_main_option('pylons_config_name'))
 
-# add your model's MetaData object here
-# for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-target_metadata = None
+url = settings.get(sqla.SQLALCHEMY_URL, sqla.DEFAULT_URL)
+target_metadata = models.Base.metadata
 
 
 def run_migrations_offline():
@@ -45,8 +39,7 @@ def run_migrations_offline():
     script output.
 
     """
-    context.configure(
-                url=meta.engine.url)
+    context.configure(url=url, target_metadata=target_metadata)
     with context.begin_transaction():
         context.run_migrations()
 
@@ -58,17 +51,9 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
-    # specify here how the engine is acquired
-    # engine = meta.engine
-    raise NotImplementedError("Please specify engine connectivity here")
-    
-    if isinstance(engine, Engine):
-        connection = engine.connect()
-    else:
-        raise Exception(
-            'Expected engine instance got %s instead' % type(engine)
-        )
-    
+    engine = sqlalchemy.create_engine(url)
+    connection = engine.connect()
+
     context.configure(
                 connection=connection,
                 target_metadata=target_metadata
@@ -0,0 +1,50 @@
+"""utilization counters
+
+``subnets.used_ips`` and ``mac_pools.used_macs`` with the indexes that
+count live rows per subnet and pool. The counters are backfilled from the
+live rows.
+
+Revision ID: 42db6dc3bb35
+Revises: e1e90be6322e
+Create Date: 2026-10-19 12:31:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '42db6dc3bb35'
+down_revision = 'e1e90be6322e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+_BACKFILL = """
+UPDATE %(table)s SET %(counter)s = (
+    SELECT count(%(counted)s.uuid) FROM %(counted)s
+    WHERE %(counted)s.%(column)s = %(table)s.uuid
+    AND %(counted)s.deallocated_at IS NULL)
+"""
+
+
+def upgrade():
+    op.add_column('subnets', sa.Column('used_ips', sa.Integer(),
+                                       nullable=False, server_default='0'))
+    op.add_column('mac_pools', sa.Column('used_macs', sa.Integer(),
+                                         nullable=False, server_default='0'))
+    op.create_index('ix_ips_subnet_uuid_deallocated_at', 'ips',
+                    ['subnet_uuid', 'deallocated_at'])
+    op.create_index('ix_macs_pool_uuid_deallocated_at', 'macs',
+                    ['pool_uuid', 'deallocated_at'])
+    op.execute(_BACKFILL % {'table': 'subnets', 'counter': 'used_ips',
+                            'counted': 'ips', 'column': 'subnet_uuid'})
+    op.execute(_BACKFILL % {'table': 'mac_pools', 'counter': 'used_macs',
+                            'counted': 'macs', 'column': 'pool_uuid'})
+
+
+def downgrade():
+    op.drop_index('ix_macs_pool_uuid_deallocated_at', table_name='macs')
+    op.drop_index('ix_ips_subnet_uuid_deallocated_at', table_name='ips')
+    with op.batch_alter_table('mac_pools') as batch:
+        batch.drop_column('used_macs')
+    with op.batch_alter_table('subnets') as batch:
+        batch.drop_column('used_ips')
@@ -0,0 +1,133 @@
+"""baseline
+
+The schema ``create_all`` built before migrations existed. Databases
+created that way are stamped with this revision, e.g.
+``alembic stamp 75225926b439``, and upgraded from there.
+
+Revision ID: 75225926b439
+Revises: None
+Create Date: 2026-10-19 12:20:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '75225926b439'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+from newtonian import custom_types as ct
+
+
+def _base():
+    return [sa.Column('uuid', ct.UUID(), primary_key=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('updated_at', sa.DateTime(), nullable=True)]
+
+
+def _fk(name, where, nullable=False):
+    return sa.Column(name, ct.UUID(), sa.ForeignKey(where),
+                     nullable=nullable)
+
+
+def _tenant():
+    return sa.Column('tenant_id', sa.String(length=255), nullable=False)
+
+
+def _tags():
+    return _fk('tag_association_uuid', 'tag_association.uuid',
+               nullable=True)
+
+
+def _route():
+    return [sa.Column('address', ct.INET(), nullable=False),
+            sa.Column('prefix', sa.Integer(), nullable=False),
+            sa.Column('next_hop', ct.INET(), nullable=False)]
+
+
+def upgrade():
+    op.create_table(
+        'tag_association',
+        *(_base() + [sa.Column('discriminator', sa.String(),
+                               nullable=True)]))
+    op.create_table(
+        'tags',
+        *(_base() + [_fk('association_uuid', 'tag_association.uuid'),
+                     sa.Column('tag', sa.String(length=255),
+                               nullable=False)]))
+    op.create_table(
+        'networks',
+        *(_base() + [_tenant(), _tags(),
+                     sa.Column('name', sa.String(length=255),
+                               nullable=False),
+                     sa.Column('state',
+                               sa.Enum('U', 'D', name='ck_network_state'),
+                               nullable=True),
+                     sa.Column('key', sa.String(length=255), nullable=True),
+                     _fk('parent_uuid', 'networks.uuid', nullable=True)]))
+    op.create_table(
+        'template_routes',
+        *(_base() + _route() + [
+            _tenant(), _tags(),
+            _fk('network_uuid', 'networks.uuid', nullable=True),
+            sa.Column('device_id', sa.String(length=255), nullable=True)]))
+    op.create_table(
+        'subnets',
+        *(_base() + [_tenant(), _tags(),
+                     _fk('network_uuid', 'networks.uuid'),
+                     sa.Column('address', ct.INET(), nullable=False),
+                     sa.Column('prefix', sa.Integer(), nullable=False),
+                     sa.Column('unique', sa.Boolean(), nullable=True),
+                     sa.Column('active', sa.Boolean(), nullable=True),
+                     sa.Column('allow_requested_ip', sa.Boolean(),
+                               nullable=True)]))
+    op.create_table(
+        'meta_ips',
+        *(_base() + [_fk('subnet_uuid', 'subnets.uuid'),
+                     sa.Column('ip', ct.INET(), nullable=True)]))
+    op.create_table(
+        'subnet_routes',
+        *(_base() + _route() + [_tags(),
+                                _fk('subnet_uuid', 'subnets.uuid')]))
+    op.create_table(
+        'ports',
+        *(_base() + [_tenant(), _tags(),
+                     _fk('network_uuid', 'networks.uuid', nullable=True),
+                     sa.Column('device_id', sa.String(length=255),
+                               nullable=False),
+                     sa.Column('state',
+                               sa.Enum('U', 'D', name='ck_port_state'),
+                               nullable=True)]))
+    op.create_table(
+        'ips',
+        *(_base() + [_tenant(), _tags(),
+                     _fk('subnet_uuid', 'subnets.uuid'),
+                     _fk('port_uuid', 'ports.uuid', nullable=True),
+                     sa.Column('address', ct.INET(), nullable=False),
+                     sa.Column('deallocated_at', sa.DateTime(),
+                               nullable=True),
+                     sa.UniqueConstraint('address', 'subnet_uuid')]))
+    op.create_table(
+        'mac_pools',
+        *(_base() + [_fk('network_uuid', 'networks.uuid', nullable=True),
+                     sa.Column('address', ct.MAC(), nullable=False),
+                     sa.Column('prefix', sa.Integer(), nullable=False)]))
+    op.create_table(
+        'macs',
+        *(_base() + [_fk('network_uuid', 'networks.uuid', nullable=True),
+                     _fk('pool_uuid', 'mac_pools.uuid'),
+                     _fk('port_uuid', 'ports.uuid'),
+                     sa.Column('address', ct.MAC(), nullable=False),
+                     sa.Column('deallocated_at', sa.DateTime(),
+                               nullable=True),
+                     sa.UniqueConstraint('address', 'network_uuid')]))
+
+
+def downgrade():
+    for table in ('macs', 'mac_pools', 'ips', 'ports', 'subnet_routes',
+                  'meta_ips', 'subnets', 'template_routes', 'networks',
+                  'tags', 'tag_association'):
+        op.drop_table(table)
+    sa.Enum(name='ck_port_state').drop(op.get_bind(), checkfirst=True)
+    sa.Enum(name='ck_network_state').drop(op.get_bind(), checkfirst=True)
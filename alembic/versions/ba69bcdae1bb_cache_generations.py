@@ -0,0 +1,28 @@
+"""cache generations
+
+``cache_generations`` holds the generation counters workers compare their
+in process caches against, see ``newtonian.port_config``.
+
+Revision ID: ba69bcdae1bb
+Revises: 42db6dc3bb35
+Create Date: 2026-10-19 14:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'ba69bcdae1bb'
+down_revision = '42db6dc3bb35'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'cache_generations',
+        sa.Column('name', sa.String(length=64), primary_key=True),
+        sa.Column('generation', sa.Integer(), nullable=False))
+
+
+def downgrade():
+    op.drop_table('cache_generations')
@@ -0,0 +1,42 @@
+"""tenant and lookup indexes
+
+Composite ``tenant_id`` indexes for tenant scoped queries and the foreign
+key indexes the set based cascade deletes look rows up by.
+
+Revision ID: e1e90be6322e
+Revises: 75225926b439
+Create Date: 2026-10-19 12:24:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e1e90be6322e'
+down_revision = '75225926b439'
+
+from alembic import op
+
+
+_INDEXES = (
+    ('ix_networks_tenant_id_parent_uuid', 'networks',
+     ['tenant_id', 'parent_uuid']),
+    ('ix_subnets_tenant_id_network_uuid', 'subnets',
+     ['tenant_id', 'network_uuid']),
+    ('ix_ports_tenant_id_network_uuid', 'ports',
+     ['tenant_id', 'network_uuid']),
+    ('ix_template_routes_tenant_id_network_uuid', 'template_routes',
+     ['tenant_id', 'network_uuid']),
+    ('ix_ips_tenant_id_subnet_uuid', 'ips', ['tenant_id', 'subnet_uuid']),
+    ('ix_ips_port_uuid', 'ips', ['port_uuid']),
+    ('ix_macs_port_uuid', 'macs', ['port_uuid']),
+    ('ix_tags_association_uuid', 'tags', ['association_uuid']),
+)
+
+
+def upgrade():
+    for name, table, columns in _INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(_INDEXES):
+        op.drop_index(name, table_name=table)
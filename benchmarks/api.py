@@ -0,0 +1,284 @@
+"""Benchmark the API hot paths through the full WSGI stack.
+
+Each target database is dropped, seeded with a realistic data set (see
+``seed.py``) and then exercised with ``get_networks``, ``get_network``,
+``create_network`` (single and bulk), ``delete_network`` (of networks
+populated with ``--delete-ports`` ports, IPs and MACs), the subnet and MAC
+pool utilization stats and ``dictify``.
+Throughput and p50/p99 latencies are written as JSON, keyed by the commit
+they were measured on, so runs can be compared::
+
+    python benchmarks/api.py --output before.json
+    python benchmarks/api.py --output after.json --compare before.json
+
+A local PostgreSQL database can be added with
+``--url postgresql://localhost/newtonian_bench``. The target database is
+dropped and recreated, never point it at real data.
+
+``--shards N`` adds a target sharded over N temporary SQLite files and
+``--shard-url`` (repeatable) one sharded over the given databases, e.g.
+several local PostgreSQL databases. Each shard is seeded with its share of
+the data set and the app routes by network (``newtonian.shard_key``).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import orm
+from webob import Request
+
+import newtonian
+from newtonian import models
+from newtonian import sqla
+
+import seed
+
+
+TENANT = "bench"
+WARMUP = 2
+
+
+def _commit():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                      stderr=open(os.devnull, "w"))
+        return out.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def _call(app, method, path, body=None):
+    request = Request.blank(path, method=method)
+    if body is not None:
+        request.body = json.dumps(body)
+        request.content_type = "application/json"
+    response = request.get_response(app)
+    if response.status_int >= 400:
+        raise RuntimeError("%s %s failed: %s" % (method, path,
+                                                 response.status))
+    return response
+
+
+def measure(fn, iterations, warmup=WARMUP, items=1):
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    start = time.time()
+    for _ in range(iterations):
+        begin = time.time()
+        fn()
+        samples.append(time.time() - begin)
+    elapsed = time.time() - start
+
+    return {"iterations": iterations,
+            "items": items,
+            "throughput": iterations * items / elapsed,
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": _percentile(samples, 50) * 1000,
+            "p99_ms": _percentile(samples, 99) * 1000}
+
+
+def _settings(urls):
+    if len(urls) == 1:
+        return {sqla.SQLALCHEMY_URL: urls[0]}
+
+    shard_ids = ["shard%i" % i for i in range(len(urls))]
+    settings = {sqla.SHARDS: " ".join(shard_ids),
+                sqla.SHARD_KEY: "network"}
+    for shard_id, url in zip(shard_ids, urls):
+        settings[sqla.SHARD_URL % shard_id] = url
+    return settings
+
+
+def run_target(urls, args):
+    """Seed and benchmark ``urls``, sharded when there is more than one.
+    """
+    engines = [sqlalchemy.create_engine(url) for url in urls]
+    seeders = []
+    networks = []
+    counts = {}
+    start = time.time()
+    for i, engine in enumerate(engines):
+        models.Base.metadata.drop_all(engine)
+        seeder = seed.Seeder(engine, networks=args.networks // len(urls),
+                             ports=args.ports // len(urls),
+                             seed=args.seed + i)
+        seeders.append(seeder)
+        networks.extend(seeder.seed())
+        for table, count in seeder.counts.items():
+            counts[table] = counts.get(table, 0) + count
+    seeded = {"seconds": time.time() - start, "rows": counts}
+    sys.stderr.write("seeded %s in %.1fs\n" % (", ".join(urls),
+                                               seeded["seconds"]))
+
+    app = newtonian.main({}, **_settings(urls))
+    rand = random.Random(args.seed)
+    created = []
+
+    def get_networks():
+        _call(app, "GET", "/networks")
+
+    def get_network():
+        _call(app, "GET", "/networks/%s" % rand.choice(networks))
+
+    def create_network():
+        body = {"name": "bench-%i" % len(created), "tenant_id": TENANT}
+        response = _call(app, "POST", "/networks", body)
+        created.append(json.loads(response.body)["network"]["uuid"])
+
+    def create_networks():
+        body = {"networks": [{"name": "bulk-%i" % i, "tenant_id": TENANT}
+                             for i in range(args.bulk)]}
+        _call(app, "POST", "/networks", body)
+
+    # NOTE: Populated networks, deleting empty ones would not measure
+    #       the cascade.
+    doomed = []
+    for i, seeder in enumerate(seeders):
+        count = len(range(i, args.iterations + WARMUP, len(seeders)))
+        doomed.extend(seeder.trees(count, args.delete_ports, TENANT))
+
+    def delete_network():
+        _call(app, "DELETE", "/networks/%s" % doomed.pop())
+
+    def subnet_stats():
+        _call(app, "GET", "/stats/subnets")
+
+    def mac_pool_stats():
+        _call(app, "GET", "/stats/mac_pools")
+
+    session = orm.sessionmaker(bind=engines[0])()
+    ports = session.query(models.Port).limit(args.dictify).all()
+
+    def dictify():
+        for port in ports:
+            port.dictify()
+
+    iterations = args.iterations
+    results = {}
+    results["get_networks"] = measure(get_networks, iterations)
+    results["get_network"] = measure(get_network, iterations)
+    results["create_network"] = measure(create_network, iterations)
+    results["create_network_bulk"] = measure(create_networks, iterations,
+                                             items=args.bulk)
+    results["delete_network"] = measure(delete_network, iterations)
+    results["subnet_stats"] = measure(subnet_stats, iterations,
+                                      items=counts["subnets"])
+    results["mac_pool_stats"] = measure(mac_pool_stats, iterations,
+                                        items=counts["mac_pools"])
+    results["dictify"] = measure(dictify, iterations, items=len(ports))
+
+    session.close()
+    for engine in engines:
+        engine.dispose()
+    return {"urls": urls, "seed": seeded, "results": results}
+
+
+def compare(old, new, tolerance):
+    """Print p50/p99 deltas and return the regressed operations.
+    """
+    regressions = []
+    for name, target in sorted(new["targets"].items()):
+        previous = old.get("targets", {}).get(name)
+        if previous is None:
+            continue
+        print("%s (%s -> %s)" % (name, old.get("commit"), new.get("commit")))
+        for op, result in sorted(target["results"].items()):
+            before = previous["results"].get(op)
+            if before is None:
+                continue
+            for key in ("p50_ms", "p99_ms"):
+                delta = (result[key] - before[key]) / before[key] * 100
+                flag = ""
+                if delta > tolerance:
+                    flag = "  REGRESSION"
+                    regressions.append((name, op, key))
+                print("  %-22s %-6s %10.3f -> %10.3f (%+.1f%%)%s" % (
+                    op, key[:3], before[key], result[key], delta, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", action="append", dest="urls",
+                        help="database url to benchmark (repeatable), "
+                             "defaults to a temporary SQLite file")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="also run sharded over this many temporary "
+                             "SQLite databases")
+    parser.add_argument("--shard-url", action="append", dest="shard_urls",
+                        help="database url of a shard (repeatable), runs "
+                             "one target sharded over all of them")
+    parser.add_argument("--ports", type=int, default=100000)
+    parser.add_argument("--networks", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--bulk", type=int, default=50)
+    parser.add_argument("--dictify", type=int, default=1000)
+    parser.add_argument("--delete-ports", type=int, default=500,
+                        help="ports (with an IP and a MAC each) under "
+                             "every network deleted")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="results JSON to compare with")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="percent slowdown reported as a regression")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    tmpdir = tempfile.mkdtemp(prefix="newtonian-bench-")
+    targets = {}
+    for url in args.urls or ["sqlite:///%s" % os.path.join(tmpdir,
+                                                          "bench.db")]:
+        name = sqlalchemy.engine.url.make_url(url).drivername
+        targets[name] = [url]
+    if args.shards > 1:
+        targets["sqlite-%i-shards" % args.shards] = [
+            "sqlite:///%s" % os.path.join(tmpdir, "shard%i.db" % i)
+            for i in range(args.shards)]
+    if args.shard_urls:
+        targets["%i-shards" % len(args.shard_urls)] = args.shard_urls
+
+    results = {"commit": _commit(),
+               "timestamp": time.time(),
+               "python": platform.python_version(),
+               "sqlalchemy": sqlalchemy.__version__,
+               "ports": args.ports,
+               "targets": {}}
+    for name, urls in sorted(targets.items()):
+        results["targets"][name] = run_target(urls, args)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    for name in os.listdir(tmpdir):
+        os.remove(os.path.join(tmpdir, name))
+    os.rmdir(tmpdir)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), results, args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
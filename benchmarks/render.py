@@ -0,0 +1,145 @@
+"""Benchmark rendering: CPU per request and bytes on the wire.
+
+A temporary database is seeded (see ``seed.py``) and large collection and
+port config responses are fetched through the full WSGI stack without
+compression, with each supported encoding, and as conditional requests
+that hit a known ETag::
+
+    python benchmarks/render.py --output render.json
+
+CPU is process user + system time, so run it on an otherwise idle box.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from webob import Request
+
+import newtonian
+from newtonian import models
+from newtonian import renderers
+from newtonian import sqla
+
+import api
+import seed
+
+
+def _cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _get(app, path, headers):
+    response = Request.blank(path, headers=headers).get_response(app)
+    if response.status_int not in (200, 304):
+        raise RuntimeError("GET %s failed: %s" % (path, response.status))
+    return response
+
+
+def _wire_bytes(response):
+    head = len(response.status) + 11
+    for name, value in response.headerlist:
+        head += len(name) + len(value) + 4
+    return head + len(response.body)
+
+
+def measure(app, paths, headers, iterations):
+    """Return CPU ms and bytes per request for GETs of ``paths``.
+    """
+    for path in paths[:2]:
+        _get(app, path, headers(path))
+
+    sizes = []
+    start, cpu = time.time(), _cpu()
+    for i in range(iterations):
+        path = paths[i % len(paths)]
+        sizes.append(_wire_bytes(_get(app, path, headers(path))))
+    cpu, elapsed = _cpu() - cpu, time.time() - start
+
+    return {"iterations": iterations,
+            "cpu_ms": cpu / iterations * 1000,
+            "wall_ms": elapsed / iterations * 1000,
+            "bytes": sum(sizes) / len(sizes)}
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix="newtonian-render-")
+    url = "sqlite:///%s" % os.path.join(tmpdir, "bench.db")
+    engine = sqlalchemy.create_engine(url)
+    seeder = seed.Seeder(engine, networks=args.networks, ports=args.ports)
+    seeder.seed()
+
+    app = newtonian.main({}, **{sqla.SQLALCHEMY_URL: url})
+    rand = random.Random(args.seed)
+    ports = [str(row[0]) for row in
+             engine.execute(sqlalchemy.select([models.Port.uuid]))]
+    configs = ["/ports/%s/config" % p
+               for p in rand.sample(ports, min(args.configs, len(ports)))]
+    collections = ["/networks", "/subnets"]
+
+    etags = {}
+    for path in collections + configs:
+        etags[path] = _get(app, path, {}).etag
+
+    encodings = ["identity", "gzip"]
+    if renderers.zstandard is not None:
+        encodings.append("zstd")
+
+    results = {}
+    targets = (("collection", collections), ("port_config", configs))
+    for name, paths in targets:
+        for encoding in encodings:
+            results["%s_%s" % (name, encoding)] = measure(
+                app, paths, lambda path: {"Accept-Encoding": encoding},
+                args.iterations)
+        results["%s_not_modified" % name] = measure(
+            app, paths, lambda path: {"Accept-Encoding": "gzip",
+                                      "If-None-Match": '"%s"' % etags[path]},
+            args.iterations)
+
+    engine.dispose()
+    os.remove(os.path.join(tmpdir, "bench.db"))
+    os.rmdir(tmpdir)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ports", type=int, default=20000)
+    parser.add_argument("--networks", type=int, default=200)
+    parser.add_argument("--configs", type=int, default=100,
+                        help="distinct ports to fetch configs for")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {"commit": api._commit(),
+               "timestamp": time.time(),
+               "python": platform.python_version(),
+               "ports": args.ports,
+               "results": run(args)}
+
+    for op, result in sorted(results["results"].items()):
+        sys.stderr.write("%-28s %8.3f cpu ms %10i bytes\n" % (
+            op, result["cpu_ms"], result["bytes"]))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
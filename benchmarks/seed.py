@@ -0,0 +1,159 @@
+"""Seed a database with a realistic IPAM data set for benchmarking.
+
+Rows are written with core ``executemany`` inserts in batches so seeding
+100k+ ports stays fast on both SQLite and PostgreSQL.
+"""
+import random
+import uuid
+
+import netaddr
+
+from newtonian import models
+from newtonian import utilization
+
+
+BATCH = 5000
+
+
+class Seeder(object):
+    def __init__(self, engine, networks=200, children=2, subnets=2,
+                 ports=100000, tags=("prod", "web", "db", "edge"),
+                 tenants=20, seed=1):
+        self.engine = engine
+        self.networks = networks
+        self.children = children
+        self.subnets = subnets
+        self.ports = ports
+        self.tags = tags
+        self.tenants = ["tenant-%i" % i for i in range(tenants)]
+        self.random = random.Random(seed)
+        self.counts = {}
+        self._pending = {}
+
+    def _insert(self, model, row):
+        table = model.__table__
+        rows = self._pending.setdefault(table, [])
+        rows.append(row)
+        self.counts[table.name] = self.counts.get(table.name, 0) + 1
+        if len(rows) >= BATCH:
+            self._flush()
+
+    def _flush(self):
+        # NOTE: Always flush every table in dependency order so
+        #       foreign keys are satisfied on PostgreSQL.
+        for table in models.Base.metadata.sorted_tables:
+            rows = self._pending.get(table)
+            if rows:
+                self.engine.execute(table.insert(), rows)
+                del rows[:]
+
+    def _tag(self, discriminator):
+        association = uuid.uuid4()
+        self._insert(models.TagAssociation, {"uuid": association,
+                                             "discriminator": discriminator})
+        self._insert(models.Tag, {"uuid": uuid.uuid4(),
+                                  "association_uuid": association,
+                                  "tag": self.random.choice(self.tags)})
+        return association
+
+    def _network(self, index, tenant, parent=None):
+        network = uuid.uuid4()
+        self._insert(models.Network, {"uuid": network,
+                                      "tenant_id": tenant,
+                                      "name": "net-%s" % index,
+                                      "state": models.NetworkState.up,
+                                      "parent_uuid": parent,
+                                      "tag_association_uuid":
+                                      self._tag("network")})
+        return network
+
+    def _tree(self, n, tenant, ports):
+        """Queue network ``n`` with its children, subnets, MAC pool and
+        ``ports`` ports, each with an IP and a MAC, and return its uuid.
+        """
+        network = self._network(n, tenant)
+        for c in range(self.children):
+            self._network("%i-%i" % (n, c), tenant, parent=network)
+
+        subnets = []
+        for s in range(self.subnets):
+            subnet = uuid.uuid4()
+            cidr = netaddr.IPNetwork("10.%i.%i.0/20" % (n % 256, s * 16))
+            subnets.append((subnet, cidr))
+            self._insert(models.Subnet, {"uuid": subnet,
+                                         "tenant_id": tenant,
+                                         "network_uuid": network,
+                                         "address": cidr.network,
+                                         "prefix": cidr.prefixlen})
+            self._insert(models.MetaIp, {"uuid": uuid.uuid4(),
+                                         "subnet_uuid": subnet,
+                                         "ip": cidr.network + 2})
+            self._insert(models.SubnetRoute, {"uuid": uuid.uuid4(),
+                                              "subnet_uuid": subnet,
+                                              "address": "0.0.0.0",
+                                              "prefix": 0,
+                                              "next_hop": cidr.network + 1})
+
+        pool = uuid.uuid4()
+        self._insert(models.MacPool, {"uuid": pool,
+                                      "network_uuid": network,
+                                      "address":
+                                      "02:%02x:00:00:00:00" % (n % 256),
+                                      "prefix": 24})
+
+        per_subnet = -(-ports // len(subnets))
+        if 10 + per_subnet >= subnets[0][1].size - 1:
+            raise ValueError("%i ports per network do not fit in %i "
+                             "subnets" % (ports, len(subnets)))
+
+        for p in range(ports):
+            port = uuid.uuid4()
+            self._insert(models.Port, {"uuid": port,
+                                       "tenant_id": tenant,
+                                       "network_uuid": network,
+                                       "device_id": "vm-%i-%i" % (n, p),
+                                       "state": models.PortState.up,
+                                       "tag_association_uuid":
+                                       self._tag("port")})
+            subnet, cidr = subnets[p % len(subnets)]
+            self._insert(models.Ip, {"uuid": uuid.uuid4(),
+                                     "tenant_id": tenant,
+                                     "subnet_uuid": subnet,
+                                     "port_uuid": port,
+                                     "address": cidr.network + 10 +
+                                     p // len(subnets),
+                                     "tag_association_uuid":
+                                     self._tag("ip")})
+            mac = "02:%02x:00:%02x:%02x:%02x" % (
+                n % 256, (p >> 16) & 0xff, (p >> 8) & 0xff, p & 0xff)
+            self._insert(models.Mac, {"uuid": uuid.uuid4(),
+                                      "network_uuid": network,
+                                      "pool_uuid": pool,
+                                      "port_uuid": port,
+                                      "address": mac})
+        return network
+
+    def _done(self):
+        self._flush()
+        # NOTE: Core inserts skip the flush events, count once.
+        utilization.reconcile(self.engine)
+
+    def seed(self):
+        """Populate the database and return the uuids of the top networks.
+        """
+        models.Base.metadata.create_all(self.engine)
+
+        ports = max(self.ports // self.networks, 1)
+        top = [self._tree(n, self.tenants[n % len(self.tenants)], ports)
+               for n in range(self.networks)]
+        self._done()
+        return top
+
+    def trees(self, count, ports, tenant):
+        """Add ``count`` more fully populated networks of ``tenant``, e.g.
+        for delete benchmarks, and return their uuids.
+        """
+        added = [self._tree(self.networks + i, tenant, ports)
+                 for i in range(count)]
+        self._done()
+        return added
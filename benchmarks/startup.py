@@ -0,0 +1,99 @@
+"""Benchmark per worker application startup.
+
+Every sample starts a fresh interpreter (as a new worker would), imports
+``newtonian`` and builds the WSGI app with ``main``. Startup is compared
+with schema creation on (the default) and off
+(``newtonian.create_schema = false``)::
+
+    python benchmarks/startup.py --workers 20 --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import sqlalchemy
+
+from newtonian import models
+
+
+_WORKER = """
+import json, sys, time
+start = time.time()
+import newtonian
+app = newtonian.main({}, **json.loads(sys.argv[1]))
+elapsed = time.time() - start
+print(json.dumps({"seconds": elapsed,
+                  "netaddr": "netaddr" in sys.modules,
+                  "postgresql": "sqlalchemy.dialects.postgresql"
+                                in sys.modules}))
+"""
+
+MODES = {"create_schema": {"newtonian.create_schema": "true"},
+         "migrations": {"newtonian.create_schema": "false"}}
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def run_mode(url, settings, workers):
+    settings = dict(settings)
+    settings["sqlalchemy.url"] = url
+    samples = []
+    last = None
+    for _ in range(workers):
+        out = subprocess.check_output([sys.executable, "-c", _WORKER,
+                                       json.dumps(settings)])
+        last = json.loads(out.strip().splitlines()[-1])
+        samples.append(last["seconds"])
+
+    return {"workers": workers,
+            "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": _percentile(samples, 50) * 1000,
+            "max_ms": max(samples) * 1000,
+            "imports_netaddr": last["netaddr"],
+            "imports_postgresql": last["postgresql"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="database url, defaults to a "
+                                      "temporary SQLite file")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    path = None
+    url = args.url
+    if url is None:
+        fd, path = tempfile.mkstemp(prefix="newtonian-startup-",
+                                    suffix=".db")
+        os.close(fd)
+        url = "sqlite:///%s" % path
+
+    # NOTE: The schema has to exist for the migrations mode, the
+    #       same as it would after running alembic.
+    models.Base.metadata.create_all(sqlalchemy.create_engine(url))
+
+    results = dict((mode, run_mode(url, settings, args.workers))
+                   for mode, settings in MODES.items())
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if path is not None:
+        os.remove(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
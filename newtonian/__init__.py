@@ -1,27 +1,46 @@
 """Main entry point
 """
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 from newtonian import models
 from newtonian import renderers
+from newtonian import resources
 from newtonian import sqla
 
 
+CREATE_SCHEMA = "newtonian.create_schema"
+
+
 def main(global_config, **settings):
     settings = dict(settings)
-    settings.setdefault(sqla.SQLALCHEMY_URL, "sqlite:///newtonian.db")
+    settings.setdefault(sqla.SQLALCHEMY_URL, sqla.DEFAULT_URL)
 
-    config = Configurator(settings=settings)
+    config = Configurator(settings=settings,
+                          root_factory=resources.get_root)
 
     config.include("pyramid_tm")
     sqla._setup_factory(config.registry)
 
+    config.include("newtonian.instrumentation")
+    config.include("newtonian.admission")
+    config.include("newtonian.port_config")
+    config.include("newtonian.utilization")
+
     config.include("cornice")
-    config.scan("newtonian.views")
-#    config.add_renderer(None, renderers.Newtonian())
+    config.add_renderer("newtonian", renderers.Newtonian())
+    config.include("newtonian.views")
 
-    # NOTE(jkoelker) Ghetto db creation, fixit, fixit, fixit, fixit
     s = config.registry.settings
     models.Base.metadata.bind = s[sqla.DBSESSION_ENGINE]
-    models.Base.metadata.create_all(s[sqla.DBSESSION_ENGINE])
+
+    # NOTE(jkoelker) Ghetto db creation, fixit, fixit, fixit, fixit
+    # NOTE: Deployments running many workers set
+    #       newtonian.create_schema = false and migrate with alembic instead.
+    if asbool(s.get(CREATE_SCHEMA, True)):
+        engines = [s[sqla.DBSESSION_ENGINE]]
+        if sqla.DBSESSION_SHARDS in s:
+            engines = s[sqla.DBSESSION_SHARDS].values()
+        for engine in engines:
+            models.Base.metadata.create_all(engine)
 
     return config.make_wsgi_app()
@@ -0,0 +1,310 @@
+"""Admission control in front of the views.
+
+Two checks run before a request opens a transaction:
+
+* A token bucket per (tenant, endpoint class) limits how fast a tenant may
+  call ``read`` (GET/HEAD), ``write`` and ``allocate`` (writes to IPs and
+  MACs) endpoints. Requests over the limit get a 429 with ``Retry-After``.
+* A concurrency limiter sized to the database pool (the smallest shard
+  pool when sharded) bounds the requests in flight. A request waits at
+  most ``queue_timeout`` seconds for a slot and is then answered with a
+  503 and ``Retry-After`` instead of queueing on the pool.
+
+Rates are read from the settings, e.g.::
+
+    newtonian.admission.rate.write = 20
+    newtonian.admission.burst.write = 50
+
+Classes without a rate are not limited. Buckets live in process memory
+unless ``newtonian.admission.redis_url`` points at a Redis server (a local
+``redis-server`` does fine), in which case every worker shares them.
+"""
+import collections
+import json
+import logging
+import math
+import threading
+import time
+
+from pyramid import httpexceptions as httpexc
+from pyramid import settings as pyramid_settings
+import sqlalchemy as sa
+
+from newtonian import sqla
+from newtonian import tenancy
+
+try:
+    import redis
+    _REDIS_ERRORS = (redis.RedisError,)
+except ImportError:
+    redis = None
+    _REDIS_ERRORS = ()
+
+
+log = logging.getLogger(__name__)
+
+
+ENABLED = "newtonian.admission"
+RATE_PREFIX = "newtonian.admission.rate."
+BURST_PREFIX = "newtonian.admission.burst."
+CONCURRENCY = "newtonian.admission.concurrency"
+QUEUE_TIMEOUT = "newtonian.admission.queue_timeout"
+RETRY_AFTER = "newtonian.admission.retry_after"
+REDIS_URL = "newtonian.admission.redis_url"
+MAX_BUCKETS = "newtonian.admission.max_buckets"
+
+CLASSES = ("read", "write", "allocate")
+_READ_METHODS = ("GET", "HEAD", "OPTIONS")
+_ALLOCATE_COLLECTIONS = ("ips", "macs")
+
+
+class HTTPTooManyRequests(httpexc.HTTPClientError):
+    code = 429
+    title = "Too Many Requests"
+    explanation = "The request rate limit has been exceeded."
+
+
+def classify(request):
+    """Return the endpoint class of ``request``.
+    """
+    if request.method in _READ_METHODS:
+        return "read"
+    segments = request.path_info.strip("/").split("/")
+    if any(s in _ALLOCATE_COLLECTIONS for s in segments):
+        return "allocate"
+    return "write"
+
+
+class LocalBuckets(object):
+    """Token buckets in process memory.
+
+    Buckets are kept in least recently used order and ones that have
+    refilled, no different from a new bucket, are dropped. At most
+    ``size`` buckets are kept whatever tenant ids clients send. A bucket
+    that has not refilled is never evicted, since sending made up tenant
+    ids would then reset its limit. Instead, while the table is full, new
+    tenants share one bucket per class.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+        self._swept = 0
+
+    def _sweep(self, now):
+        while self._buckets:
+            oldest = next(iter(self._buckets))
+            if self._buckets[oldest][2] > now:
+                break
+            del self._buckets[oldest]
+
+        # NOTE: Refilled buckets behind a busy one are only found by
+        #       walking the whole table, do that at most once a second
+        #       and only when it is full.
+        if len(self._buckets) >= self.size and now - self._swept >= 1:
+            self._swept = now
+            for key in [k for k, v in self._buckets.iteritems()
+                        if v[2] <= now]:
+                del self._buckets[key]
+
+    def take(self, key, rate, burst):
+        """Take a token, return 0 or the seconds until one is available.
+        """
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            if key not in self._buckets and len(self._buckets) >= self.size:
+                key = (None, key[1])
+            tokens, stamp, _ = self._buckets.pop(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return wait
+
+
+# NOTE: The caller passes the clock so the script only writes
+#       deterministic values and replicates on any Redis version.
+_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "stamp")
+local tokens = tonumber(state[1]) or burst
+local stamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens),
+           "stamp", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets(object):
+    """Token buckets shared through Redis, updated by a Lua script.
+
+    Errors talking to Redis let the request through rather than failing
+    every request with it.
+    """
+
+    def __init__(self, client, prefix="newtonian:admission:"):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(_TAKE)
+
+    @classmethod
+    def from_url(cls, url):
+        if redis is None:
+            raise ValueError("redis is not installed")
+        return cls(redis.StrictRedis.from_url(url))
+
+    def take(self, key, rate, burst):
+        try:
+            wait = self._take(keys=[self.prefix + ":".join(key)],
+                              args=[rate, burst, repr(time.time())])
+        except _REDIS_ERRORS:
+            log.exception("rate limit backend unavailable")
+            return 0.0
+        return float(wait)
+
+
+class Limiter(object):
+    """Bound the requests in flight, waiting at most ``timeout`` for a slot.
+    """
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while self.active >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+def pool_capacity(engine):
+    """Return how many connections ``engine`` can hand out, or None.
+    """
+    pool = engine.pool
+    if not isinstance(pool, sa.pool.QueuePool):
+        return None
+    overflow = getattr(pool, "_max_overflow", 0)
+    if overflow < 0:
+        return None
+    return pool.size() + overflow
+
+
+def capacity(settings):
+    """Return how many requests the database pools can serve at once, or
+    None if they are unbounded.
+
+    A sharded request holds at most one connection per shard (see
+    ``sqla.fan_out``), so the smallest shard pool is the bound.
+    """
+    engines = settings.get(sqla.DBSESSION_SHARDS)
+    if not engines:
+        return pool_capacity(settings[sqla.DBSESSION_ENGINE])
+    capacities = [pool_capacity(engine) for engine in engines.values()]
+    capacities = [c for c in capacities if c is not None]
+    if not capacities:
+        return None
+    return min(capacities)
+
+
+def _rates(settings):
+    rates = {}
+    for name in CLASSES:
+        rate = settings.get(RATE_PREFIX + name)
+        if rate is None:
+            continue
+        rate = float(rate)
+        burst = float(settings.get(BURST_PREFIX + name, max(rate, 1)))
+        rates[name] = (rate, burst)
+    return rates
+
+
+def _reject(exc, retry_after):
+    exc.headers["Retry-After"] = str(int(math.ceil(retry_after)))
+    exc.content_type = "application/json"
+    exc.body = json.dumps({"code": exc.code, "title": exc.title,
+                           "explanation": exc.explanation,
+                           "detail": exc.detail})
+    return exc
+
+
+def tween_factory(handler, registry):
+    settings = registry.settings
+    rates = _rates(settings)
+
+    buckets = None
+    if rates:
+        url = settings.get(REDIS_URL)
+        if url:
+            buckets = RedisBuckets.from_url(url)
+        else:
+            buckets = LocalBuckets(int(settings.get(MAX_BUCKETS, 10000)))
+
+    limiter = None
+    limit = settings.get(CONCURRENCY)
+    if limit is None:
+        limit = capacity(settings)
+    if limit is not None and int(limit) > 0:
+        limiter = Limiter(int(limit),
+                          float(settings.get(QUEUE_TIMEOUT, 0.5)))
+    retry_after = float(settings.get(RETRY_AFTER, 1))
+
+    def tween(request):
+        kind = classify(request)
+        if kind in rates:
+            rate, burst = rates[kind]
+            tenant = tenancy.tenant_id(request) or ""
+            wait = buckets.take((tenant, kind), rate, burst)
+            if wait:
+                log.debug("rate limited %s %s for tenant %r" %
+                          (kind, request.path, tenant))
+                return _reject(HTTPTooManyRequests(), wait)
+
+        if limiter is None:
+            return handler(request)
+
+        if not limiter.acquire():
+            log.debug("no slot for %s %s" % (request.method, request.path))
+            return _reject(httpexc.HTTPServiceUnavailable(), retry_after)
+        try:
+            return handler(request)
+        finally:
+            limiter.release()
+
+    return tween
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if not pyramid_settings.asbool(settings.get(ENABLED, True)):
+        return
+
+    config.add_tween("newtonian.admission.tween_factory",
+                     over="pyramid_tm.tm_tween_factory")
@@ -0,0 +1,187 @@
+"""Set based cascading deletes.
+
+Deleting a ``Network`` through the ORM loads every subnet, port, IP, MAC,
+route and tag association one at a time. ``delete_networks`` instead
+removes the whole dependent graph, including ``children`` networks, with a
+handful of DELETE statements issued in foreign key order inside the
+current transaction.
+
+IPs from other networks' subnets that were bound to a deleted port are
+deallocated rather than deleted. Deleted IP and MAC rows free their
+addresses for allocation again, and the utilization counters of surviving
+subnets and MAC pools are decremented for them.
+"""
+import datetime
+import logging
+
+import sqlalchemy as sa
+import zope.sqlalchemy
+
+from newtonian import models
+from newtonian import sqla
+
+
+log = logging.getLogger(__name__)
+
+
+def descendants(session, uuids, shard_id=None):
+    """Return ``uuids`` plus the uuids of all their child networks.
+    """
+    networks = models.Network.__table__
+    found = list(uuids)
+    seen = set(found)
+    frontier = found
+    while frontier:
+        query = sa.select([networks.c.uuid])
+        query = query.where(networks.c.parent_uuid.in_(frontier))
+        frontier = [row[0] for row in sqla.execute(session, query,
+                                                   shard_id=shard_id)
+                    if row[0] not in seen]
+        seen.update(frontier)
+        found.extend(frontier)
+    return found
+
+
+def owners(session, uuids, shard_id=None):
+    """Return the tenants owning rows ``delete_networks(uuids)`` deletes.
+    """
+    networks = models.Network.__table__
+    subnets = models.Subnet.__table__
+    ports = models.Port.__table__
+    ips = models.Ip.__table__
+    template_routes = models.TemplateRoute.__table__
+
+    nets = descendants(session, uuids, shard_id)
+    in_subnets = sa.select([subnets.c.uuid]).where(
+        subnets.c.network_uuid.in_(nets))
+    query = sa.union(
+        sa.select([networks.c.tenant_id]).where(networks.c.uuid.in_(nets)),
+        sa.select([subnets.c.tenant_id]).where(
+            subnets.c.network_uuid.in_(nets)),
+        sa.select([ports.c.tenant_id]).where(ports.c.network_uuid.in_(nets)),
+        sa.select([ips.c.tenant_id]).where(ips.c.subnet_uuid.in_(in_subnets)),
+        sa.select([template_routes.c.tenant_id]).where(
+            template_routes.c.network_uuid.in_(nets)))
+    return set(row[0] for row in sqla.execute(session, query,
+                                              shard_id=shard_id))
+
+
+def delete_networks(session, uuids, shard_id=None):
+    """Delete the networks ``uuids`` and everything hanging off them.
+
+    When sharded every statement runs on ``shard_id``, the shard the
+    networks live on. Returns a dict of collection name to number of rows
+    affected.
+    """
+    networks = models.Network.__table__
+    subnets = models.Subnet.__table__
+    ports = models.Port.__table__
+    ips = models.Ip.__table__
+    macs = models.Mac.__table__
+    mac_pools = models.MacPool.__table__
+    meta_ips = models.MetaIp.__table__
+    subnet_routes = models.SubnetRoute.__table__
+    template_routes = models.TemplateRoute.__table__
+    tags = models.Tag.__table__
+    tag_association = models.TagAssociation.__table__
+
+    nets = descendants(session, uuids, shard_id)
+    in_subnets = sa.select([subnets.c.uuid]).where(
+        subnets.c.network_uuid.in_(nets))
+    in_ports = sa.select([ports.c.uuid]).where(
+        ports.c.network_uuid.in_(nets))
+    in_pools = sa.select([mac_pools.c.uuid]).where(
+        mac_pools.c.network_uuid.in_(nets))
+
+    # NOTE: Tag associations are referenced by the rows about to
+    #       go, so collect them up front and remove them last.
+    tagged = ((networks, networks.c.uuid.in_(nets)),
+              (subnets, subnets.c.network_uuid.in_(nets)),
+              (ports, ports.c.network_uuid.in_(nets)),
+              (ips, ips.c.subnet_uuid.in_(in_subnets)),
+              (subnet_routes, subnet_routes.c.subnet_uuid.in_(in_subnets)),
+              (template_routes, template_routes.c.network_uuid.in_(nets)))
+
+    def run(statement, params=None):
+        return sqla.execute(session, statement, params, shard_id)
+
+    associations = []
+    for table, where in tagged:
+        column = table.c.tag_association_uuid
+        query = sa.select([column]).where(sa.and_(where, column != None))
+        associations.extend(row[0] for row in run(query))
+
+    counts = {}
+
+    def execute(name, statement, params=None):
+        result = run(statement, params)
+        counts[name] = counts.get(name, 0) + result.rowcount
+
+    # NOTE: The flush events never see these rows, keep the
+    #       counters of subnets and pools that survive in step.
+    live_ips = sa.and_(ips.c.port_uuid.in_(in_ports),
+                       ips.c.deallocated_at == None)
+    released = sa.select([sa.func.count(ips.c.uuid)]).where(
+        sa.and_(live_ips, ips.c.subnet_uuid == subnets.c.uuid))
+    run(subnets.update().where(
+        sa.and_(~subnets.c.network_uuid.in_(nets),
+                subnets.c.uuid.in_(sa.select([ips.c.subnet_uuid]).where(
+                    live_ips)))).values(
+        used_ips=subnets.c.used_ips - released.as_scalar()))
+
+    live_macs = sa.and_(sa.or_(macs.c.port_uuid.in_(in_ports),
+                               macs.c.network_uuid.in_(nets)),
+                        macs.c.deallocated_at == None)
+    freed = sa.select([sa.func.count(macs.c.uuid)]).where(
+        sa.and_(live_macs, macs.c.pool_uuid == mac_pools.c.uuid))
+    run(mac_pools.update().where(
+        sa.and_(sa.or_(mac_pools.c.network_uuid == None,
+                       ~mac_pools.c.network_uuid.in_(nets)),
+                mac_pools.c.uuid.in_(sa.select([macs.c.pool_uuid]).where(
+                    live_macs)))).values(
+        used_macs=mac_pools.c.used_macs - freed.as_scalar()))
+
+    execute("released_ips", ips.update().where(
+        sa.and_(ips.c.port_uuid.in_(in_ports),
+                ~ips.c.subnet_uuid.in_(in_subnets))).values(
+        port_uuid=None,
+        deallocated_at=sa.func.coalesce(ips.c.deallocated_at,
+                                        datetime.datetime.utcnow())))
+    execute(ips.name, ips.delete().where(ips.c.subnet_uuid.in_(in_subnets)))
+    execute(meta_ips.name, meta_ips.delete().where(
+        meta_ips.c.subnet_uuid.in_(in_subnets)))
+    execute(subnet_routes.name, subnet_routes.delete().where(
+        subnet_routes.c.subnet_uuid.in_(in_subnets)))
+    execute(macs.name, macs.delete().where(
+        sa.or_(macs.c.port_uuid.in_(in_ports),
+               macs.c.network_uuid.in_(nets),
+               macs.c.pool_uuid.in_(in_pools))))
+    execute(mac_pools.name, mac_pools.delete().where(
+        mac_pools.c.network_uuid.in_(nets)))
+    execute(ports.name, ports.delete().where(
+        ports.c.network_uuid.in_(nets)))
+    execute(template_routes.name, template_routes.delete().where(
+        template_routes.c.network_uuid.in_(nets)))
+    execute(subnets.name, subnets.delete().where(
+        subnets.c.network_uuid.in_(nets)))
+
+    # NOTE: Break the self reference first so the order rows are
+    #       removed in does not matter.
+    run(networks.update().where(
+        networks.c.uuid.in_(nets)).values(parent_uuid=None))
+    execute(networks.name, networks.delete().where(
+        networks.c.uuid.in_(nets)))
+
+    # NOTE: One compiled statement run with executemany, huge
+    #       IN lists spend more time compiling than deleting.
+    if associations:
+        params = [{"association": uuid} for uuid in associations]
+        association = sa.bindparam("association")
+        execute(tags.name, tags.delete().where(
+            tags.c.association_uuid == association), params)
+        execute(tag_association.name, tag_association.delete().where(
+            tag_association.c.uuid == association), params)
+
+    zope.sqlalchemy.mark_changed(session)
+    log.debug("cascade deleted networks %s: %s" % (nets, counts))
+    return counts
@@ -1,12 +1,29 @@
 
+import importlib
 import re
 import uuid
 
-import netaddr
-
 import sqlalchemy as sa
 from sqlalchemy import types
-from sqlalchemy.dialects import postgresql
+
+
+class LazyModule(object):
+    """Import ``name`` on first attribute access.
+
+    Keeps heavy modules out of application (and worker) startup.
+    """
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attr)
+
+
+netaddr = LazyModule("netaddr")
 
 
 class INET(types.TypeDecorator):
@@ -14,6 +31,7 @@ class INET(types.TypeDecorator):
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
+            from sqlalchemy.dialects import postgresql
             return dialect.type_descriptor(postgresql.INET())
 
         return dialect.type_descriptor(types.CHAR(39))
@@ -47,6 +65,7 @@ class MAC(types.TypeDecorator):
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
+            from sqlalchemy.dialects import postgresql
             return dialect.type_descriptor(postgresql.MACADDR())
 
         return dialect.type_descriptor(types.CHAR(16))
@@ -76,6 +95,7 @@ class UUID(types.TypeDecorator):
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
+            from sqlalchemy.dialects import postgresql
             return dialect.type_descriptor(postgresql.UUID())
 
         return dialect.type_descriptor(types.CHAR(36))
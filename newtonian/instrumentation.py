@@ -0,0 +1,271 @@
+"""Per request timings and SQL instrumentation.
+
+The tween records how long each request spends in the database (via the
+engine cursor events), serializing models (``dictify``) and rendering. The
+numbers go out as a ``Server-Timing`` header, are aggregated per route and
+served in the Prometheus text format from ``newtonian.metrics_path``.
+
+Requests whose query count grows with the number of serialized items are
+flagged as probable N+1 patterns.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from pyramid import response
+from pyramid import settings as pyramid_settings
+from pyramid import tweens
+import sqlalchemy as sa
+
+from newtonian import sqla
+
+
+log = logging.getLogger(__name__)
+
+
+STATS = "newtonian.stats"
+ENABLED = "newtonian.instrumentation"
+METRICS_PATH = "newtonian.metrics_path"
+N_PLUS_ONE_THRESHOLD = "newtonian.n_plus_one_threshold"
+
+_PHASES = ("db", "serialize", "render")
+_QUERY_START = "newtonian.query_start"
+_local = threading.local()
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.total = 0.0
+        self.timings = dict((phase, 0.0) for phase in _PHASES)
+        self.queries = 0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add(self, phase, elapsed):
+        with self._lock:
+            self.timings[phase] += elapsed
+
+    def query(self, elapsed):
+        with self._lock:
+            self.queries += 1
+            self.timings["db"] += elapsed
+
+    def finish(self):
+        self.total = time.time() - self.start
+
+    def n_plus_one(self, threshold):
+        return (self.items > 1 and self.queries > threshold and
+                self.queries >= self.items)
+
+    def server_timing(self):
+        parts = ["%s;dur=%.3f" % (phase, self.timings[phase] * 1000)
+                 for phase in _PHASES]
+        parts.append("total;dur=%.3f" % (self.total * 1000))
+        return ", ".join(parts)
+
+
+def current(request=None):
+    """Return the ``RequestStats`` being collected, if any.
+    """
+    if request is not None:
+        return request.environ.get(STATS)
+    return getattr(_local, "stats", None)
+
+
+@contextlib.contextmanager
+def timed(request, phase):
+    stats = current(request)
+    if stats is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats.add(phase, time.time() - start)
+
+
+@contextlib.contextmanager
+def collecting(stats):
+    """Count the SQL run by this thread into ``stats``, e.g. in a worker
+    thread reading on behalf of a request.
+
+    Queries running in parallel threads each add their own time, so
+    ``db`` can then exceed the wall time of the request.
+    """
+    previous = getattr(_local, "stats", None)
+    _local.stats = stats
+    try:
+        yield
+    finally:
+        _local.stats = previous
+
+
+def count_items(request, count):
+    stats = current(request)
+    if stats is not None:
+        stats.items += count
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault(_QUERY_START, []).append(time.time())
+
+
+def _finish_query(conn):
+    starts = conn.info.get(_QUERY_START)
+    if not starts:
+        return
+    start = starts.pop()
+    stats = current()
+    if stats is not None:
+        stats.query(time.time() - start)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    _finish_query(conn)
+
+
+def _dbapi_error(conn, cursor, statement, parameters, context, exception):
+    # NOTE: A failed execute never reaches after_cursor_execute, count it
+    #       here so its start time does not linger on the connection.
+    _finish_query(conn)
+
+
+def instrument_engine(engine):
+    if getattr(engine, "_newtonian_instrumented", False):
+        return
+    sa.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sa.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    sa.event.listen(engine, "dbapi_error", _dbapi_error)
+    engine._newtonian_instrumented = True
+
+
+class _Metrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, stats, n_plus_one=False):
+        with self._lock:
+            values = self._routes.setdefault(route, {"requests": 0,
+                                                     "queries": 0,
+                                                     "n_plus_one": 0,
+                                                     "total": 0.0,
+                                                     "db": 0.0,
+                                                     "serialize": 0.0,
+                                                     "render": 0.0})
+            values["requests"] += 1
+            values["queries"] += stats.queries
+            values["n_plus_one"] += int(n_plus_one)
+            values["total"] += stats.total
+            for phase in _PHASES:
+                values[phase] += stats.timings[phase]
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+    def prometheus(self):
+        with self._lock:
+            routes = sorted((k, dict(v)) for k, v in self._routes.items())
+
+        lines = []
+
+        def family(name, kind, help_):
+            lines.append("# HELP %s %s" % (name, help_))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        family("newtonian_requests_total", "counter",
+               "Requests handled.")
+        for route, values in routes:
+            lines.append('newtonian_requests_total{route="%s"} %i' %
+                         (route, values["requests"]))
+
+        family("newtonian_request_seconds_total", "counter",
+               "Seconds spent handling requests, split by phase.")
+        for route, values in routes:
+            for phase in ("total",) + _PHASES:
+                lines.append('newtonian_request_seconds_total'
+                             '{route="%s",phase="%s"} %.6f' %
+                             (route, phase, values[phase]))
+
+        family("newtonian_db_queries_total", "counter",
+               "SQL statements executed.")
+        for route, values in routes:
+            lines.append('newtonian_db_queries_total{route="%s"} %i' %
+                         (route, values["queries"]))
+
+        family("newtonian_n_plus_one_total", "counter",
+               "Requests whose query count scaled with the result size.")
+        for route, values in routes:
+            lines.append('newtonian_n_plus_one_total{route="%s"} %i' %
+                         (route, values["n_plus_one"]))
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = _Metrics()
+
+
+def _route_name(request):
+    route = getattr(request, "matched_route", None)
+    if route is None:
+        return "notfound"
+    return route.name
+
+
+def tween_factory(handler, registry):
+    settings = registry.settings
+    threshold = int(settings.get(N_PLUS_ONE_THRESHOLD, 10))
+
+    def tween(request):
+        stats = request.environ[STATS] = _local.stats = RequestStats()
+        try:
+            resp = handler(request)
+        finally:
+            _local.stats = None
+            stats.finish()
+            n_plus_one = stats.n_plus_one(threshold)
+            metrics.record(_route_name(request), stats, n_plus_one)
+
+        if n_plus_one:
+            log.warning("possible N+1 on %s %s: %i queries for %i items" %
+                        (request.method, request.path, stats.queries,
+                         stats.items))
+            resp.headers["X-Newtonian-N-Plus-One"] = "%i/%i" % (
+                stats.queries, stats.items)
+
+        resp.headers["Server-Timing"] = stats.server_timing()
+        resp.headers["X-Newtonian-Db-Queries"] = str(stats.queries)
+        return resp
+
+    return tween
+
+
+def metrics_view(request):
+    body = metrics.prometheus()
+    return response.Response(body=body,
+                             content_type="text/plain; version=0.0.4")
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if not pyramid_settings.asbool(settings.get(ENABLED, True)):
+        return
+
+    instrument_engine(settings[sqla.DBSESSION_ENGINE])
+    for engine in settings.get(sqla.DBSESSION_SHARDS, {}).values():
+        instrument_engine(engine)
+    config.add_tween("newtonian.instrumentation.tween_factory",
+                     under=tweens.INGRESS)
+
+    path = settings.get(METRICS_PATH, "/metrics")
+    config.add_route("metrics", path)
+    config.add_view(metrics_view, route_name="metrics",
+                    request_method="GET")
@@ -4,8 +4,6 @@ import logging
 import re
 import uuid
 
-import netaddr
-
 import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.ext import associationproxy
@@ -14,6 +12,8 @@ from sqlalchemy.ext import declarative
 from newtonian import custom_types as ct
 
 
+netaddr = ct.LazyModule("netaddr")
+
 log = logging.getLogger(__name__)
 
 
@@ -55,8 +55,11 @@ class NewtonianBase(object):
             value = getattr(self, key)
             if hasattr(value, "dict"):
                 value = value.dict()
-            elif isinstance(value, (datetime.datetime, uuid.UUID)):
+            elif isinstance(value, (datetime.datetime, uuid.UUID,
+                                    netaddr.IPAddress, netaddr.EUI)):
                 value = str(value)
+            elif isinstance(value, ct.EnumSymbol):
+                value = value.value
             elif isinstance(value, list):
                 newvalue = []
                 for item in value:
@@ -97,7 +100,18 @@ class IsHazTenant(object):
     tenant_id = sa.Column(sa.String(255), nullable=False)
 
 
+def TenantIndex(table, *columns):
+    """Composite index leading with tenant_id for tenant scoped queries"""
+    name = "ix_%s_tenant_id" % table
+    if columns:
+        name = "%s_%s" % (name, "_".join(columns))
+    return sa.Index(name, "tenant_id", *columns)
+
+
 class Tag(Base):
+    __table_args__ = (sa.Index("ix_tags_association_uuid",
+                               "association_uuid"),)
+
     association_uuid = ForeignKey("tag_association.uuid")
 
     tag = sa.Column(sa.String(255), nullable=False)
@@ -163,6 +177,8 @@ class IsHazRoute(object):
 
 
 class TemplateRoute(Base, IsHazRoute, IsHazTenant, IsHazTags):
+    __table_args__ = (TenantIndex("template_routes", "network_uuid"),)
+
     network_uuid = ForeignKey("networks.uuid", nullable=True)
     network = orm.relationship("Network")
     device_id = sa.Column(sa.String(255))
@@ -174,6 +190,8 @@ class SubnetRoute(Base, IsHazRoute, IsHazTags):
 
 
 class Subnet(Base, IsHazTenant, IsHazTags):
+    __table_args__ = (TenantIndex("subnets", "network_uuid"),)
+
     network_uuid = ForeignKey("networks.uuid")
     network = orm.relationship("Network", backref="subnets")
     address = sa.Column(ct.INET, nullable=False)
@@ -183,6 +201,10 @@ class Subnet(Base, IsHazTenant, IsHazTags):
     unique = sa.Column(sa.Boolean, default=False)
     active = sa.Column(sa.Boolean, default=True)
     allow_requested_ip = sa.Column(sa.Boolean, default=True)
+    # NOTE: Live (not deallocated) ips, kept up to date by
+    #       newtonian.utilization
+    used_ips = sa.Column(sa.Integer, nullable=False, default=0,
+                         server_default="0")
 
     @property
     def netaddr(self):
@@ -194,15 +216,23 @@ class Subnet(Base, IsHazTenant, IsHazTags):
 
 
 class Ip(Base, IsHazTenant, IsHazTags):
-    __table_args__ = (sa.UniqueConstraint("address", "subnet_uuid"),)
-
-    subnet_uuid = ForeignKey("subnets.uuid")
+    __table_args__ = (sa.UniqueConstraint("address", "subnet_uuid"),
+                      sa.Index("ix_ips_port_uuid", "port_uuid"),
+                      sa.Index("ix_ips_subnet_uuid_deallocated_at",
+                               "subnet_uuid", "deallocated_at"),
+                      TenantIndex("ips", "subnet_uuid"))
+
+    subnet_uuid = orm.column_property(ForeignKey("subnets.uuid"),
+                                      active_history=True)
     subnet = orm.relationship("Subnet", backref="ips")
     port_uuid = ForeignKey("ports.uuid", nullable=True)
     port = orm.relationship("Port", backref="ips")
 
     address = sa.Column(ct.INET, nullable=False)
-    deallocated_at = sa.Column(sa.DateTime)
+    # NOTE: The utilization counters need the previous value on
+    #       every change, even when it was never loaded.
+    deallocated_at = orm.column_property(sa.Column(sa.DateTime),
+                                         active_history=True)
 
     def deallocate(self):
         self.deallocated_at = datetime.datetime.utcnow()
@@ -213,26 +243,37 @@ class MacPool(Base):
     network = orm.relationship("Network", backref="mac_pools")
     address = sa.Column(ct.MAC, nullable=False)
     prefix = sa.Column(sa.Integer, nullable=False)
+    # NOTE: Live (not deallocated) macs, kept up to date by
+    #       newtonian.utilization
+    used_macs = sa.Column(sa.Integer, nullable=False, default=0,
+                          server_default="0")
 
 
 class Mac(Base):
-    __table_args__ = (sa.UniqueConstraint("address", "network_uuid"),)
+    __table_args__ = (sa.UniqueConstraint("address", "network_uuid"),
+                      sa.Index("ix_macs_port_uuid", "port_uuid"),
+                      sa.Index("ix_macs_pool_uuid_deallocated_at",
+                               "pool_uuid", "deallocated_at"))
 
     network_uuid = ForeignKey("networks.uuid", nullable=True)
     network = orm.relationship("Network")
-    pool_uuid = ForeignKey("mac_pools.uuid")
+    pool_uuid = orm.column_property(ForeignKey("mac_pools.uuid"),
+                                    active_history=True)
     pool = orm.relationship("MacPool", backref="macs")
     port_uuid = ForeignKey("ports.uuid")
     port = orm.relationship("Port", uselist=False, backref="mac")
 
     address = sa.Column(ct.MAC, nullable=False)
-    deallocated_at = sa.Column(sa.DateTime)
+    deallocated_at = orm.column_property(sa.Column(sa.DateTime),
+                                         active_history=True)
 
     def deallocate(self):
         self.deallocated_at = datetime.datetime.utcnow()
 
 
 class Port(Base, IsHazTenant, IsHazTags):
+    __table_args__ = (TenantIndex("ports", "network_uuid"),)
+
     network_uuid = ForeignKey("networks.uuid", nullable=True)
     network = orm.relationship("Network",
                                backref=orm.backref("ports",
@@ -243,8 +284,19 @@ class Port(Base, IsHazTenant, IsHazTags):
 
 
 class Network(Base, IsHazTenant, IsHazTags):
+    __table_args__ = (TenantIndex("networks", "parent_uuid"),)
+
     name = sa.Column(sa.String(255), nullable=False)
     state = sa.Column(NetworkState.db_type())
     key = sa.Column(sa.String(255))
     parent_uuid = ForeignKey("networks.uuid", nullable=True)
     children = orm.relationship("Network", lazy="joined", join_depth=2)
+
+
+# NOTE: Not a model. One row per in process cache, bumped whenever the
+#       rows the cache is built from change so every worker drops it,
+#       see newtonian.port_config.
+cache_generations = sa.Table(
+    "cache_generations", Base.metadata,
+    sa.Column("name", sa.String(64), primary_key=True),
+    sa.Column("generation", sa.Integer, nullable=False))
@@ -0,0 +1,310 @@
+"""Per port network configuration documents.
+
+An agent configuring a VM needs the port's MACs and IPs, each subnet's DNS
+servers (``MetaIp``) and ``SubnetRoute``s, and the ``TemplateRoute``s that
+apply to the port. ``build`` assembles all of that in a fixed number of
+queries regardless of how many IPs or routes the port has, and ``cache``
+keeps the finished documents so repeated boot time fetches are served from
+memory. Each cached document carries an ETag derived from its content, so
+the renderer can answer conditional requests and reuse encoded bodies.
+
+Cached documents are invalidated from the session events whenever a flush
+touches one of the models they are built from, and again once the
+transaction commits. Every invalidation bumps the cache generation, and a
+document is only stored if the generation did not move while it was being
+built, so a reader racing a commit never caches what it read before it.
+
+The cache is per process. Every commit that invalidated documents also
+bumps the ``port_config`` row of ``cache_generations``, and each lookup
+reads that row first and drops the whole cache when it moved, so changes
+committed by other workers are never served (nor answered with a 304).
+Scripts that change rows outside the session (``newtonian_import``,
+``newtonian_reconcile``) call ``bump`` themselves. Entries also expire
+after ``newtonian.port_config.ttl`` seconds to bound memory held by ports
+that are no longer fetched.
+"""
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from newtonian import models
+
+
+log = logging.getLogger(__name__)
+
+
+CACHE_SIZE = "newtonian.port_config.cache_size"
+TTL = "newtonian.port_config.ttl"
+
+_ALL = object()
+_GENERATION = "port_config"
+_PENDING = "_newtonian_port_config_pending"
+_PORT_MODELS = (models.Ip, models.Mac)
+_SHARED_MODELS = (models.Subnet, models.MetaIp, models.SubnetRoute,
+                  models.TemplateRoute)
+
+
+def _route(route):
+    return {"destination": "%s/%i" % (route.address, route.prefix),
+            "next_hop": str(route.next_hop)}
+
+
+def build(session, port_uuid):
+    """Return the configuration document for port ``port_uuid`` or None.
+    """
+    query = session.query(models.Port, models.Mac)
+    query = query.outerjoin(models.Mac,
+                            sa.and_(models.Mac.port_uuid == models.Port.uuid,
+                                    models.Mac.deallocated_at == None))
+    rows = query.filter(models.Port.uuid == port_uuid).all()
+    if not rows:
+        return None
+
+    port = rows[0][0]
+    macs = [str(mac.address) for _, mac in rows if mac is not None]
+
+    query = session.query(models.Ip, models.Subnet)
+    query = query.join(models.Subnet,
+                       models.Ip.subnet_uuid == models.Subnet.uuid)
+    ips = query.filter(models.Ip.port_uuid == port.uuid,
+                       models.Ip.deallocated_at == None).all()
+
+    subnets = dict((subnet.uuid, subnet) for _, subnet in ips)
+    dns = collections.defaultdict(list)
+    routes = collections.defaultdict(list)
+    if subnets:
+        query = session.query(models.MetaIp)
+        for meta in query.filter(models.MetaIp.subnet_uuid.in_(subnets)):
+            dns[meta.subnet_uuid].append(str(meta.ip))
+
+        query = session.query(models.SubnetRoute)
+        query = query.filter(models.SubnetRoute.subnet_uuid.in_(subnets))
+        for route in query:
+            routes[route.subnet_uuid].append(route)
+
+    TemplateRoute = models.TemplateRoute
+    query = session.query(TemplateRoute)
+    query = query.filter(
+        TemplateRoute.tenant_id == port.tenant_id,
+        sa.or_(TemplateRoute.network_uuid == port.network_uuid,
+               TemplateRoute.network_uuid == None),
+        sa.or_(TemplateRoute.device_id == port.device_id,
+               TemplateRoute.device_id == None))
+    templates = query.all()
+
+    addresses = []
+    for ip, subnet in ips:
+        subnet_routes = routes[subnet.uuid]
+        gateway = None
+        for route in subnet_routes:
+            if route.prefix == 0:
+                gateway = str(route.next_hop)
+        addresses.append({"address": str(ip.address),
+                          "version": ip.address.version,
+                          "subnet": {"uuid": str(subnet.uuid),
+                                     "cidr": "%s/%i" % (subnet.address,
+                                                        subnet.prefix),
+                                     "gateway": gateway,
+                                     "dns": dns[subnet.uuid],
+                                     "routes": [_route(r)
+                                                for r in subnet_routes]}})
+
+    state = port.state
+    if state is not None:
+        state = state.value
+
+    return {"uuid": str(port.uuid),
+            "tenant_id": port.tenant_id,
+            "network_uuid": port.network_uuid and str(port.network_uuid),
+            "device_id": port.device_id,
+            "state": state,
+            "macs": macs,
+            "ips": addresses,
+            "routes": [_route(r) for r in templates]}
+
+
+class _Cache(object):
+
+    def __init__(self, size=10000, ttl=10):
+        self.size = size
+        self.ttl = ttl
+        self.generation = 0
+        self.shared = None
+        self._lock = threading.Lock()
+        self._documents = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._documents.pop(key, None)
+            if entry is None or entry[2] <= time.time():
+                return None
+            self._documents[key] = entry
+            return entry[:2]
+
+    def set(self, key, document, etag, generation):
+        """Store ``document`` unless anything was invalidated since the
+        cache was at ``generation``.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._documents.pop(key, None)
+            self._documents[key] = (document, etag, time.time() + self.ttl)
+            while len(self._documents) > self.size:
+                self._documents.popitem(last=False)
+
+    def sync(self, shared):
+        """Drop every document if the shared generation moved.
+        """
+        with self._lock:
+            if shared == self.shared:
+                return
+            self.shared = shared
+        self.invalidate()
+
+    def invalidate(self, uuids=_ALL):
+        with self._lock:
+            self.generation += 1
+            if uuids is _ALL:
+                self._documents.clear()
+                return
+            for key in uuids:
+                self._documents.pop(key, None)
+
+
+cache = _Cache()
+
+
+def shared_generation(connectable):
+    """Return the generation of the cache shared by every process.
+    """
+    table = models.cache_generations
+    query = sa.select([table.c.generation]).where(
+        table.c.name == _GENERATION)
+    # NOTE: Unrouted statements go to the first shard when sharded.
+    return connectable.execute(query).scalar() or 0
+
+
+def bump(connectable):
+    """Make every process drop its cached documents, e.g. after changing
+    rows without going through a session.
+    """
+    table = models.cache_generations
+    update = table.update().where(table.c.name == _GENERATION).values(
+        generation=table.c.generation + 1)
+    if connectable.execute(update).rowcount:
+        return
+    try:
+        connectable.execute(table.insert().values(name=_GENERATION,
+                                                  generation=1))
+    except sa.exc.IntegrityError:
+        connectable.execute(update)
+
+
+def etag(document):
+    encoded = json.dumps(document, sort_keys=True, separators=(",", ":"))
+    return hashlib.md5(encoded).hexdigest()
+
+
+def lookup(session, port_uuid):
+    """Return the (possibly cached) configuration document for a port and
+    its ETag, or ``(None, None)``.
+
+    Raises ``ValueError`` if ``port_uuid`` is not a valid uuid.
+    """
+    key = str(uuid.UUID(str(port_uuid)))
+    cache.sync(shared_generation(session))
+    entry = cache.get(key)
+    if entry is None:
+        generation = cache.generation
+        document = build(session, key)
+        if document is None:
+            return None, None
+        entry = (document, etag(document))
+        cache.set(key, document, entry[1], generation)
+    return entry
+
+
+def invalidate_on_commit(session, uuids=_ALL):
+    """Drop cached documents now and again once ``session`` commits.
+
+    Pass no ``uuids`` to drop every document, e.g. after bulk statements
+    that bypass the flush events.
+    """
+    pending = session.__dict__.setdefault(_PENDING, set())
+    if uuids is _ALL:
+        pending.add(_ALL)
+    else:
+        uuids = [str(u) for u in uuids if u is not None]
+        pending.update(uuids)
+    cache.invalidate(uuids)
+
+
+def _affected(session):
+    uuids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, _SHARED_MODELS):
+            return _ALL
+        elif isinstance(obj, models.Port):
+            uuids.add(obj.uuid)
+        elif isinstance(obj, _PORT_MODELS):
+            history = orm.attributes.get_history(obj, "port_uuid")
+            uuids.update(history.sum())
+    return uuids
+
+
+def _after_flush(session, flush_context):
+    uuids = _affected(session)
+    if uuids:
+        invalidate_on_commit(session, uuids)
+
+
+def _drop_pending(session):
+    pending = session.__dict__.pop(_PENDING, None)
+    if pending:
+        if _ALL in pending:
+            cache.invalidate()
+        else:
+            cache.invalidate(pending)
+    return pending
+
+
+def _after_commit(session):
+    if not _drop_pending(session):
+        return
+    try:
+        bump(session.get_bind(None))
+    except sa.exc.DBAPIError:
+        log.exception("could not bump the shared port config generation, "
+                      "other workers serve cached documents for up to "
+                      "%ss" % cache.ttl)
+
+
+def _after_rollback(session):
+    # NOTE: The session may have cached documents built from its own
+    #       flushed, now rolled back, rows. No other process saw them.
+    _drop_pending(session)
+
+
+_listening = False
+
+
+def includeme(config):
+    global _listening
+
+    settings = config.registry.settings
+    cache.size = int(settings.get(CACHE_SIZE, cache.size))
+    cache.ttl = float(settings.get(TTL, cache.ttl))
+
+    if not _listening:
+        sa.event.listen(orm.Session, "after_flush", _after_flush)
+        sa.event.listen(orm.Session, "after_commit", _after_commit)
+        sa.event.listen(orm.Session, "after_rollback", _after_rollback)
+        _listening = True
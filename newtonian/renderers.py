@@ -1,9 +1,36 @@
+"""Content negotiated rendering with compression and body reuse.
+
+Bodies of at least ``newtonian.compression.min_size`` bytes are compressed
+with the best encoding the client accepts (zstd when ``zstandard`` is
+installed, then gzip).
+
+Successful GET responses carry an ETag, either set by the view (e.g. from a
+cached document) or hashed from the encoded body, and ``If-None-Match``
+hits are answered with a 304. The ETag of a compressed variant gets the
+encoding appended (``"<etag>-gzip"``) so every content-coding has its own
+strong validator, the suffix is ignored when matching. Encoded and
+compressed bodies are kept in a size bounded LRU keyed by ETag, content
+type and encoding: a view supplied ETag skips serialization entirely, a
+hashed one still skips compression.
+"""
+import collections
+import hashlib
 import logging
+import threading
+import zlib
 
 from pyramid import renderers
 from pyramid import interfaces as pyramid_interfaces
+from pyramid import settings as pyramid_settings
 from zope.interface import registry
 
+from newtonian import instrumentation
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 try:
     json_factory = renderers.JSON()
@@ -11,15 +38,82 @@ except AttributeError:
     json_factory = renderers.json_renderer_factory
 
 
+COMPRESSION = "newtonian.compression"
+MIN_SIZE = "newtonian.compression.min_size"
+GZIP_LEVEL = "newtonian.compression.gzip_level"
+ZSTD_LEVEL = "newtonian.compression.zstd_level"
+BODY_CACHE_BYTES = "newtonian.body_cache.max_bytes"
+
 _DEFAULT_SERIALIZERS = (('application/json', json_factory(None)), )
 _MARKER = object()
+_CACHEABLE_METHODS = ('GET', 'HEAD')
+_ENCODINGS = ('gzip', 'zstd')
 LOG = logging.getLogger(__name__)
 
 
+def _gzip(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def _zstd(body, level):
+    return zstandard.ZstdCompressor(level=level).compress(body)
+
+
+def _variant(etag, encoding):
+    if encoding is None:
+        return etag
+    return '%s-%s' % (etag, encoding)
+
+
+def _strip_variant(etag):
+    base, sep, encoding = etag.rpartition('-')
+    if sep and encoding in _ENCODINGS:
+        return base
+    return etag
+
+
+class _Bodies(object):
+    """LRU of encoded bodies bounded by their total size.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._bodies = collections.OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._bodies.pop(key, None)
+            if entry is not None:
+                self._bodies[key] = entry
+            return entry
+
+    def set(self, key, body, encoding):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._bodies.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._bodies[key] = (body, encoding)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._bodies.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._bodies.clear()
+            self.size = 0
+
+
 class Newtonian(object):
     def __init__(self, serializers=_DEFAULT_SERIALIZERS):
         self.components = registry.Components()
         self.content_types = []
+        self.bodies = _Bodies()
 
         for content_type, serializer in serializers:
             self.add_serializer(content_type, serializer)
@@ -40,18 +134,90 @@ class Newtonian(object):
         return result
 
     def __call__(self, info):
-        default_content_type = info.settings.get('default_content_type',
-                                                 'application/json')
+        settings = info.settings or {}
+        default_content_type = settings.get('default_content_type',
+                                            'application/json')
+        min_size = int(settings.get(MIN_SIZE, 1024))
+        levels = {'gzip': int(settings.get(GZIP_LEVEL, 6)),
+                  'zstd': int(settings.get(ZSTD_LEVEL, 3))}
+        compressors = {'gzip': _gzip, 'zstd': _zstd}
+
+        encodings = ()
+        if pyramid_settings.asbool(settings.get(COMPRESSION, True)):
+            encodings = ('gzip',)
+            if zstandard is not None:
+                encodings = ('zstd', 'gzip')
+        self.bodies.max_bytes = int(settings.get(BODY_CACHE_BYTES,
+                                                 self.bodies.max_bytes))
+
+        def _negotiate(request):
+            if not encodings or 'Accept-Encoding' not in request.headers:
+                return None
+            return request.accept_encoding.best_match(encodings)
+
+        def _not_modified(request, response, etag, encoding):
+            response.etag = _variant(etag, encoding)
+            match = request.if_none_match
+            tags = getattr(match, 'etags', None)
+            if tags is not None:
+                match = [_strip_variant(tag) for tag in tags]
+            if etag in match:
+                response.status = 304
+                response.content_encoding = None
+                return True
+            return False
+
+        def _serve(response, body, encoding):
+            response.content_encoding = encoding
+            return body
 
         def _render(value, system):
-            LOG.debug(value)
             request = system.get('request')
             response = request.response
 
             content_type = request.accept.best_match(self.content_types,
                                                      default_content_type)
             response.content_type = content_type
+            response.vary = ('Accept', 'Accept-Encoding')
+            encoding = _negotiate(request)
+
+            cacheable = (request.method in _CACHEABLE_METHODS and
+                         response.status_int == 200)
+            etag = response.etag if cacheable else None
+            supplied = etag is not None
+            if supplied:
+                if _not_modified(request, response, etag, encoding):
+                    return b''
+                entry = self.bodies.get((etag, content_type, encoding))
+                if entry is not None:
+                    return _serve(response, *entry)
+
             serializer = self.get_serializer(content_type)
-            return serializer(value, system)
+            with instrumentation.timed(request, "render"):
+                body = serializer(value, system)
+                if isinstance(body, unicode):
+                    body = body.encode(response.charset or 'utf-8')
+
+                if cacheable and etag is None:
+                    etag = hashlib.md5(body).hexdigest()
+                    if _not_modified(request, response, etag, encoding):
+                        return b''
+                    if encoding is not None and len(body) >= min_size:
+                        key = (etag, content_type, encoding)
+                        entry = self.bodies.get(key)
+                        if entry is not None:
+                            return _serve(response, *entry)
+
+                applied = None
+                if encoding is not None and len(body) >= min_size:
+                    body = compressors[encoding](body, levels[encoding])
+                    applied = encoding
+
+            # NOTE: A hashed ETag is only known after serializing,
+            #       so only the compressed form is worth keeping.
+            if supplied or (etag is not None and applied is not None):
+                self.bodies.set((etag, content_type, encoding), body,
+                                applied)
+            return _serve(response, body, applied)
 
         return _render
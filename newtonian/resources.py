@@ -1,22 +1,173 @@
+"""Traversal resources over the models.
+
+``/networks/{uuid}/subnets/{uuid}/ips/{uuid}`` resolves through ``Root``,
+``Collection`` and ``Item`` resources. The first lookup from the root loads
+every ``{uuid}`` on the request path in a single joined query and caches
+the objects on the request, so parents are never fetched twice and views
+can use ``request.root`` instead of re-querying by uuid.
+"""
+import uuid
+
+from sqlalchemy import orm
+
+from newtonian import models
 from newtonian import sqla
+from newtonian import tenancy
+
+
+RESOURCES = "newtonian.resources"
+
+_ROOTS = dict((model.__collection_name__, model)
+              for model in (models.Network, models.Subnet, models.Port,
+                            models.Ip))
+
+# NOTE: Parent model -> child collection -> (child model, column
+#       on the child referencing the parent's uuid)
+_CHILDREN = {
+    models.Network: {"networks": (models.Network, "parent_uuid"),
+                     "subnets": (models.Subnet, "network_uuid"),
+                     "ports": (models.Port, "network_uuid"),
+                     "mac_pools": (models.MacPool, "network_uuid")},
+    models.Subnet: {"ips": (models.Ip, "subnet_uuid"),
+                    "routes": (models.SubnetRoute, "subnet_uuid"),
+                    "dns": (models.MetaIp, "subnet_uuid")},
+    models.Port: {"ips": (models.Ip, "port_uuid")},
+    models.MacPool: {"macs": (models.Mac, "pool_uuid")},
+}
+
+
+def _cache(request):
+    return request.environ.setdefault(RESOURCES, {})
+
+
+def _uuid(key):
+    try:
+        return str(uuid.UUID(key))
+    except ValueError:
+        return None
+
+
+def _scope(request, query, entity):
+    tenant = tenancy.tenant_id(request)
+    if tenant is None or not tenancy.is_scoped(entity):
+        return query
+    return query.filter(entity.tenant_id == tenant)
+
+
+def _chain(segments):
+    """Yield (name, model, column, uuid) for the leading uuid segments.
+    """
+    parent = None
+    for i in range(0, len(segments) - 1, 2):
+        name, key = segments[i], _uuid(segments[i + 1])
+        if parent is None:
+            model, column = _ROOTS.get(name), None
+        else:
+            model, column = _CHILDREN.get(parent, {}).get(name, (None, None))
+        if model is None or key is None:
+            return
+        yield name, model, column, key
+        parent = model
+
 
-class Resource(dict):
-    def __init__(self, request, name, parent, model, column, filter):
-        super(dict, self).__init__()
-        self.__name__ = __name__
+def prefetch(request, segments):
+    """Load every object named by ``segments`` in one joined query.
+    """
+    chain = list(_chain(segments))
+    if not chain:
+        return
+
+    entities = [orm.aliased(model) for _, model, _, _ in chain]
+    query = sqla.dbsession(request).query(*entities)
+    parent = None
+    for entity, (_, _, column, key) in zip(entities, chain):
+        query = query.filter(entity.uuid == key)
+        if column is not None:
+            query = query.filter(getattr(entity, column) == parent.uuid)
+        query = _scope(request, query, entity)
+        parent = entity
+
+    row = query.first()
+    if row is None:
+        return
+    if len(entities) == 1:
+        row = (row,)
+
+    cache = _cache(request)
+    path = ()
+    for obj, (name, _, _, key) in zip(row, chain):
+        path += (name, key)
+        cache[path] = obj
+
+
+class Collection(object):
+    def __init__(self, request, name, parent, model, column=None):
+        self.request = request
+        self.__name__ = name
+        self.__parent__ = parent
+        self.model = model
+        self.column = column
+        self.path = parent.path + (name,)
+
+    def query(self):
+        query = tenancy.scoped_query(self.request, self.model)
+        if self.column is not None:
+            column = getattr(self.model, self.column)
+            query = query.filter(column == self.__parent__.model.uuid)
+        return query
+
+    def __getitem__(self, key):
+        key = _uuid(key)
+        if key is None:
+            raise KeyError(key)
+
+        path = self.path + (key,)
+        cache = _cache(self.request)
+        obj = cache.get(path)
+        if obj is None:
+            obj = self.query().filter(self.model.uuid == key).first()
+            if obj is None:
+                raise KeyError(key)
+            cache[path] = obj
+        return Item(self.request, key, self, obj)
+
+
+class Item(object):
+    def __init__(self, request, name, parent, model):
+        self.request = request
+        self.__name__ = name
         self.__parent__ = parent
-        self.__model__ = model
-        self.__column__ = column
-        self.__filter__ = filter
+        self.model = model
+        self.path = parent.path + (name,)
 
     def __getitem__(self, key):
-        if key in self:
-            return super(dict, self).__getitem__(key)
+        children = _CHILDREN.get(type(self.model), {})
+        if key not in children:
+            raise KeyError(key)
+        model, column = children[key]
+        return Collection(self.request, key, self, model, column)
 
-        session = sqla.dbsession(request)
 
+class Root(object):
+    __name__ = ''
+    __parent__ = None
+    path = ()
+
+    def __init__(self, request):
+        self.request = request
+        self._prefetched = False
+
+    def __getitem__(self, key):
+        if key not in _ROOTS:
+            raise KeyError(key)
+
+        if not self._prefetched:
+            self._prefetched = True
+            segments = self.request.path_info.strip('/').split('/')
+            prefetch(self.request, segments)
 
+        return Collection(self.request, key, self, _ROOTS[key])
 
 
 def get_root(request):
-    pass
+    return Root(request)
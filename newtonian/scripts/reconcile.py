@@ -0,0 +1,71 @@
+"""Fix drift in the subnet and MAC pool utilization counters.
+
+    newtonian_reconcile newtonian.ini#pyramidapp
+    newtonian_reconcile newtonian.ini#pyramidapp --interval 300
+
+Runs ``newtonian.utilization.reconcile`` on the database (or every shard)
+once, or every ``--interval`` seconds until interrupted. Every worker drops
+its cached port configs after a run that corrected anything.
+"""
+import argparse
+import logging
+import sys
+import time
+
+from pyramid import paster
+
+from newtonian import port_config
+from newtonian import sqla
+from newtonian import utilization
+
+
+log = logging.getLogger(__name__)
+
+
+def run(engine):
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        fixed = utilization.reconcile(conn)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+    return fixed
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description="Reconcile the utilization counters.")
+    parser.add_argument("config_uri", help="paste ini file and app, e.g. "
+                                           "newtonian.ini#pyramidapp")
+    parser.add_argument("--interval", type=float,
+                        help="seconds between runs, run once if not given")
+    args = parser.parse_args(argv[1:])
+
+    paster.setup_logging(args.config_uri)
+    settings = dict(paster.get_appsettings(args.config_uri))
+    settings.setdefault(sqla.SQLALCHEMY_URL, sqla.DEFAULT_URL)
+    engines = sqla.shard_engines(settings)
+    if not engines:
+        engines = {"default": sqla.create_engine(settings)}
+
+    while True:
+        start = time.time()
+        try:
+            fixed = dict((shard_id, run(engine))
+                         for shard_id, engine in engines.items())
+            if any(any(counts.values()) for counts in fixed.values()):
+                port_config.bump(engines.values()[0])
+        except Exception:
+            if args.interval is None:
+                raise
+            log.exception("reconcile failed")
+        else:
+            log.info("reconciled in %.3fs: %s" % (time.time() - start, fixed))
+
+        if args.interval is None:
+            return
+        time.sleep(max(0, args.interval - (time.time() - start)))
@@ -0,0 +1,485 @@
+"""Stream the IPAM database to and from NDJSON or msgpack.
+
+    newtonian_export newtonian.ini#pyramidapp snapshot.ndjson
+    newtonian_import newtonian.ini#pyramidapp snapshot.ndjson
+
+Every table is written in foreign key order as a header record
+(``{"table": ..., "columns": [...]}``) followed by one list per row. Rows
+are read with server side cursors and written as they arrive, so memory
+use stays constant however large the database is.
+
+The import inserts in batches, one transaction per batch, with COPY on
+PostgreSQL and ``executemany`` elsewhere. After every batch the input
+offset is written to a checkpoint file; re-running the same import after
+a failure resumes from the last checkpoint. A batch can commit without its
+checkpoint being written, so after resuming rows that already exist are
+skipped until a batch comes up with none. Once done every worker drops
+its cached port configs.
+
+A sharded database is exported and imported one shard at a time with
+``--shard``, into a database sharded the same way::
+
+    newtonian_export newtonian.ini#pyramidapp east.ndjson --shard east
+    newtonian_import other.ini#pyramidapp east.ndjson --shard east
+"""
+import argparse
+import cStringIO
+import datetime
+import json
+import logging
+import operator
+import os
+import re
+import sys
+
+from pyramid import paster
+from pyramid import settings as pyramid_settings
+import sqlalchemy as sa
+
+from newtonian import custom_types as ct
+from newtonian import models
+from newtonian import port_config
+from newtonian import sqla
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+log = logging.getLogger(__name__)
+
+
+CHUNK = 10000
+_EXISTING_CHUNK = 500
+FORMATS = ("ndjson", "msgpack")
+_DATETIME_SPLIT = re.compile(r"[-T :.]")
+# NOTE: Stored differently on each dialect (an IPv4 address is
+#       ::ffff: mapped text on SQLite, inet on PostgreSQL). They
+#       are exported as the text of the value the type loads and
+#       imported through the type again.
+_TEXT_TYPES = (ct.UUID, ct.INET, ct.MAC)
+
+
+def _encoder(column):
+    if isinstance(column.type, sa.DateTime):
+        return operator.methodcaller("isoformat")
+    elif isinstance(column.type, ct.DeclEnumType):
+        return operator.attrgetter("value")
+    elif isinstance(column.type, _TEXT_TYPES):
+        return str
+    return None
+
+
+def _encode(encoders, row):
+    return [value if encoder is None or value is None else encoder(value)
+            for encoder, value in zip(encoders, row)]
+
+
+def _parse_datetime(value):
+    # NOTE: strptime is the slowest part of an import, the values
+    #       are always naive isoformat() output.
+    parts = _DATETIME_SPLIT.split(value)
+    if len(parts) == 7:
+        parts[6] = parts[6].ljust(6, "0")
+    elif len(parts) != 6:
+        raise ValueError("Invalid datetime: %r" % value)
+    return datetime.datetime(*[int(part) for part in parts])
+
+
+def _decoder(column):
+    if isinstance(column.type, sa.DateTime):
+        return _parse_datetime
+    elif isinstance(column.type, ct.DeclEnumType):
+        return column.type.enum.from_string
+    return None
+
+
+def _self_references(table):
+    return [fk.parent for fk in table.foreign_keys
+            if fk.column.table is table]
+
+
+class _JSONWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, record):
+        self.stream.write(json.dumps(record, separators=(",", ":")))
+        self.stream.write("\n")
+
+
+class _MsgpackWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.packer = msgpack.Packer(use_bin_type=True)
+
+    def write(self, record):
+        self.stream.write(self.packer.pack(record))
+
+
+def _read_json(stream, offset):
+    if offset:
+        stream.seek(offset)
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        yield json.loads(line), stream.tell()
+
+
+def _read_msgpack(stream, offset):
+    if offset:
+        stream.seek(offset)
+    unpacker = msgpack.Unpacker(stream, raw=False)
+    for record in unpacker:
+        yield record, offset + unpacker.tell()
+
+
+def _format(path, fmt):
+    if fmt is None:
+        fmt = "ndjson"
+        if os.path.splitext(path)[1] in (".msgpack", ".mpk"):
+            fmt = "msgpack"
+    if fmt == "msgpack" and msgpack is None:
+        raise ValueError("msgpack is not installed")
+    return fmt
+
+
+def _rows(conn, table, columns, chunk):
+    result = conn.execute(sa.select(columns))
+    while True:
+        rows = result.fetchmany(chunk)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def _ordered_rows(conn, table, columns, chunk):
+    """Yield rows of a self referencing table parents first.
+
+    Only the keys are held in memory; this is meant for ``networks``,
+    which is small next to ports, IPs and MACs.
+    """
+    references = _self_references(table)
+    query = sa.select([table.c.uuid] + references)
+    parents = dict((row[0], [p for p in row[1:] if p is not None])
+                   for row in conn.execute(query))
+
+    order = []
+    done = set()
+    while parents:
+        level = [key for key, refs in parents.iteritems()
+                 if all(p in done or p not in parents for p in refs)]
+        if not level:
+            raise ValueError("Reference cycle in %s" % table.name)
+        for key in level:
+            del parents[key]
+        done.update(level)
+        order.extend(level)
+
+    position = dict((key, i) for i, key in enumerate(order))
+    for i in xrange(0, len(order), chunk):
+        query = sa.select(columns).where(
+            table.c.uuid.in_(order[i:i + chunk]))
+        rows = sorted(conn.execute(query),
+                      key=lambda row: position[row["uuid"]])
+        for row in rows:
+            yield row
+
+
+def export(engine, writer, chunk=CHUNK):
+    """Write every table to ``writer`` and return the row counts.
+    """
+    counts = {}
+    conn = engine.connect()
+    options = {"stream_results": True}
+    if engine.dialect.name == "postgresql":
+        options["isolation_level"] = "REPEATABLE READ"
+    conn = conn.execution_options(**options)
+    trans = conn.begin()
+    try:
+        for table in models.Base.metadata.sorted_tables:
+            # NOTE: Not data, the import bumps it instead.
+            if table is models.cache_generations:
+                continue
+            columns = list(table.columns)
+            encoders = [_encoder(c) for c in columns]
+            writer.write({"table": table.name,
+                          "columns": [c.name for c in columns]})
+
+            rows = _rows
+            if _self_references(table):
+                rows = _ordered_rows
+
+            count = 0
+            for row in rows(conn, table, columns, chunk):
+                writer.write(_encode(encoders, row))
+                count += 1
+            counts[table.name] = count
+            log.info("exported %i rows from %s" % (count, table.name))
+    finally:
+        trans.rollback()
+        conn.close()
+    return counts
+
+
+def _copy_text(value):
+    if value is None:
+        return "\\N"
+    elif value is True:
+        return "t"
+    elif value is False:
+        return "f"
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = str(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def _copy(conn, table, columns, rows):
+    dialect = conn.dialect
+    processors = [c.type.bind_processor(dialect) for c in columns]
+    buf = cStringIO.StringIO()
+    for row in rows:
+        values = []
+        for column, processor in zip(columns, processors):
+            value = row[column.name]
+            if processor is not None:
+                value = processor(value)
+            values.append(_copy_text(value))
+        buf.write("\t".join(values))
+        buf.write("\n")
+    buf.seek(0)
+
+    preparer = dialect.identifier_preparer
+    statement = "COPY %s (%s) FROM STDIN" % (
+        preparer.format_table(table),
+        ", ".join(preparer.format_column(c) for c in columns))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buf)
+    finally:
+        cursor.close()
+
+
+def _insert(engine, table, columns, rows):
+    conn = engine.connect()
+    trans = conn.begin()
+    try:
+        if engine.dialect.name == "postgresql":
+            _copy(conn, table, columns, rows)
+        else:
+            conn.execute(table.insert(), rows)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _existing(engine, table, rows):
+    """Return the uuids of ``rows`` already in ``table``.
+    """
+    column = table.c.uuid
+    uuids = [row["uuid"] for row in rows]
+    found = set()
+    conn = engine.connect()
+    try:
+        for i in range(0, len(uuids), _EXISTING_CHUNK):
+            query = sa.select([column]).where(
+                column.in_(uuids[i:i + _EXISTING_CHUNK]))
+            found.update(str(row[0]) for row in conn.execute(query))
+    finally:
+        conn.close()
+    return found
+
+
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_checkpoint(path, state):
+    if path is None:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
+
+
+def load(engine, records, checkpoint=None, chunk=CHUNK):
+    """Insert ``records`` (as made by a reader) and return the row counts.
+
+    ``records`` must start at the offset recorded in ``checkpoint``, see
+    ``resume_offset``.
+    """
+    state = _load_checkpoint(checkpoint) or {"offset": 0, "table": None,
+                                             "columns": None, "counts": {}}
+    counts = state["counts"]
+    table = columns = decoders = None
+    batch = []
+    resuming = [state["offset"] > 0]
+
+    def start(name, names):
+        table = models.Base.metadata.tables[name]
+        columns = [table.c[n] for n in names]
+        return table, columns, [_decoder(c) for c in columns]
+
+    def flush(offset):
+        if batch:
+            rows = batch
+            if resuming[0]:
+                existing = _existing(engine, table, batch)
+                resuming[0] = bool(existing)
+                if existing:
+                    log.info("skipping %i %s rows imported before resuming" %
+                             (len(existing), table.name))
+                    rows = [row for row in batch
+                            if row["uuid"] not in existing]
+            if rows:
+                _insert(engine, table, columns, rows)
+            counts[table.name] = counts.get(table.name, 0) + len(batch)
+            del batch[:]
+        state["offset"] = offset
+        _save_checkpoint(checkpoint, state)
+
+    if state["table"] is not None:
+        table, columns, decoders = start(state["table"], state["columns"])
+
+    position = state["offset"]
+    for record, next_position in records:
+        if isinstance(record, dict):
+            flush(position)
+            table, columns, decoders = start(record["table"],
+                                             record["columns"])
+            state["table"] = record["table"]
+            state["columns"] = record["columns"]
+            position = next_position
+            log.info("importing %s" % table.name)
+            continue
+
+        row = {}
+        for column, decoder, value in zip(columns, decoders, record):
+            if decoder is not None and value is not None:
+                value = decoder(value)
+            row[column.name] = value
+        batch.append(row)
+        position = next_position
+
+        if len(batch) >= chunk:
+            flush(position)
+
+    flush(position)
+    return counts
+
+
+def resume_offset(checkpoint):
+    state = _load_checkpoint(checkpoint)
+    if state is None:
+        return 0
+    return state["offset"]
+
+
+def _parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("config_uri", help="paste ini file and app, e.g. "
+                                           "newtonian.ini#pyramidapp")
+    parser.add_argument("path", help="snapshot file, '-' for stdio")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="defaults from the file extension")
+    parser.add_argument("--chunk", type=int, default=CHUNK)
+    parser.add_argument("--shard", help="shard to work on, required when "
+                                        "the database is sharded")
+    return parser
+
+
+def _engines(parser, args):
+    """Return the engine of the database (or ``--shard``) to work on and
+    the one holding the cache generations.
+    """
+    paster.setup_logging(args.config_uri)
+    settings = dict(paster.get_appsettings(args.config_uri))
+    settings.setdefault(sqla.SQLALCHEMY_URL, sqla.DEFAULT_URL)
+    shards = pyramid_settings.aslist(settings.get(sqla.SHARDS, ""))
+    if not shards:
+        if args.shard is not None:
+            parser.error("--shard given but the database is not sharded")
+        engine = sqla.create_engine(settings)
+        return engine, engine
+
+    if args.shard not in shards:
+        parser.error("the database is sharded, pass --shard (one of %s) "
+                     "and run once per shard" % ", ".join(shards))
+    engines = sqla.shard_engines(settings)
+    return engines[args.shard], engines.values()[0]
+
+
+def export_main(argv=sys.argv):
+    parser = _parser("Export the IPAM database.")
+    args = parser.parse_args(argv[1:])
+    engine, _ = _engines(parser, args)
+    fmt = _format(args.path, args.format)
+
+    stream = sys.stdout
+    if args.path != "-":
+        stream = open(args.path, "wb")
+
+    writer = _JSONWriter(stream)
+    if fmt == "msgpack":
+        writer = _MsgpackWriter(stream)
+
+    try:
+        counts = export(engine, writer, args.chunk)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    log.info("exported %i rows" % sum(counts.values()))
+
+
+def import_main(argv=sys.argv):
+    parser = _parser("Import an IPAM database export.")
+    parser.add_argument("--checkpoint",
+                        help="resume file, defaults to PATH.checkpoint")
+    parser.add_argument("--create-schema", action="store_true",
+                        help="create missing tables before importing")
+    args = parser.parse_args(argv[1:])
+    engine, generations = _engines(parser, args)
+    fmt = _format(args.path, args.format)
+
+    checkpoint = args.checkpoint
+    if checkpoint is None and args.path != "-":
+        checkpoint = args.path + ".checkpoint"
+
+    if args.create_schema:
+        models.Base.metadata.create_all(engine)
+
+    read = _read_json
+    if fmt == "msgpack":
+        read = _read_msgpack
+
+    offset = resume_offset(checkpoint)
+    if offset:
+        log.info("resuming from offset %i" % offset)
+
+    stream = sys.stdin
+    if args.path != "-":
+        stream = open(args.path, "rb")
+
+    try:
+        counts = load(engine, read(stream, offset), checkpoint, args.chunk)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    port_config.bump(generations)
+    log.info("imported %i rows" % sum(counts.values()))
@@ -2,24 +2,51 @@
 # https://github.com/khufuproject/khufu_sqlalchemy
 
 
+import collections
 import json
 import logging
+import threading
+import zlib
 
+from pyramid import settings as pyramid_settings
 import sqlalchemy
 import sqlalchemy.orm
-import sqlalchemy.ext.declarative
+from sqlalchemy.ext import horizontal_shard
+from sqlalchemy.sql import expression
+from sqlalchemy.sql import operators
 import zope.sqlalchemy
 
+from newtonian import models
+
 
 log = logging.getLogger(__name__)
 
 
 SQLALCHEMY_URL = "sqlalchemy.url"
+DEFAULT_URL = "sqlite:///newtonian.db"
 SQLALCHEMY_CONNECT_KWARGS = "sqlalchemy.connect_kwargs"
 DBSESSION = "dbsession"
 DBSESSION_ENGINE = "dbengine"
 DBSESSION_ENGINE_KWARGS = "dbengine_kwargs"
 DBSESSION_FACTORY = "dbsession_factory"
+DBSESSION_SHARDS = "dbshards"
+DBSESSION_READERS = "dbshard_readers"
+
+SHARDS = "sqlalchemy.shards"
+SHARD_URL = "sqlalchemy.shard.%s.url"
+SHARD_KEY = "newtonian.shard_key"
+SHARD_MAP = "newtonian.shard_map"
+SHARD_KEYS = ("tenant_id", "network")
+SHARD_TWOPHASE = "sqlalchemy.shard_twophase"
+
+_SHARD_ID = "_newtonian_shard_id"
+_WRITTEN = "_newtonian_shards_written"
+_HELD = "_newtonian_engines_held"
+
+
+class CrossShardError(Exception):
+    """A write that cannot be kept on a single shard.
+    """
 
 
 def _setup_factory(registry):
@@ -31,6 +58,24 @@ def _setup_factory(registry):
     if DBSESSION_FACTORY in settings:
         return settings[DBSESSION_FACTORY]
 
+    if DBSESSION_SHARDS in settings:
+        engines = settings[DBSESSION_SHARDS]
+        router = ShardRouter(engines.keys(),
+                             settings.get(SHARD_KEY, "tenant_id"),
+                             parse_shard_map(settings.get(SHARD_MAP)))
+        kwargs = router.session_kwargs(engines)
+        settings[DBSESSION_READERS] = sqlalchemy.orm.sessionmaker(**kwargs)
+
+        kwargs["extension"] = zope.sqlalchemy.ZopeTransactionExtension()
+        kwargs["expire_on_commit"] = False
+        twophase = pyramid_settings.asbool(settings.get(SHARD_TWOPHASE))
+        kwargs["twophase"] = twophase
+        factory = sqlalchemy.orm.sessionmaker(**kwargs)
+        router.track(factory, single_shard_writes=not twophase)
+        factory = sqlalchemy.orm.scoped_session(factory)
+        settings[DBSESSION_FACTORY] = factory
+        return factory
+
     if DBSESSION_ENGINE in settings:
         engine = settings[DBSESSION_ENGINE]
         kwargs = {"extension": zope.sqlalchemy.ZopeTransactionExtension(),
@@ -41,7 +86,22 @@ def _setup_factory(registry):
         settings[DBSESSION_FACTORY] = factory
         return factory
 
-    url = settings[SQLALCHEMY_URL]
+    engines = shard_engines(settings)
+    if engines:
+        settings[DBSESSION_SHARDS] = engines
+        # NOTE: The first shard doubles as the default engine for
+        #       anything that is not shard aware.
+        settings[DBSESSION_ENGINE] = engines.values()[0]
+    else:
+        settings[DBSESSION_ENGINE] = create_engine(settings)
+    return _setup_factory(registry)
+
+
+def create_engine(settings, url=None):
+    """Create an engine from ``sqlalchemy.url`` and the connect kwargs.
+    """
+    if url is None:
+        url = settings[SQLALCHEMY_URL]
     kwargs = {}
 
     additional_kwargs = settings.get(SQLALCHEMY_CONNECT_KWARGS, None)
@@ -50,9 +110,336 @@ def _setup_factory(registry):
             additional_kwargs = json.loads(additional_kwargs)
         kwargs.update(additional_kwargs)
 
-    engine = sqlalchemy.create_engine(url, **kwargs)
-    settings[DBSESSION_ENGINE] = engine
-    return _setup_factory(registry)
+    return sqlalchemy.create_engine(url, **kwargs)
+
+
+def shard_engines(settings):
+    """Return an ordered dict of shard id to engine, empty if unsharded.
+
+    Shards are listed in ``sqlalchemy.shards`` and each one needs a
+    ``sqlalchemy.shard.<id>.url``.
+    """
+    engines = collections.OrderedDict()
+    for shard_id in pyramid_settings.aslist(settings.get(SHARDS, "")):
+        url = settings.get(SHARD_URL % shard_id)
+        if url is None:
+            raise ValueError("No %s setting" % (SHARD_URL % shard_id))
+        engines[shard_id] = create_engine(settings, url)
+    return engines
+
+
+def parse_shard_map(value):
+    """Parse ``key=shard`` pairs separated by whitespace or newlines.
+    """
+    shard_map = {}
+    for item in pyramid_settings.aslist(value or ""):
+        key, sep, shard_id = item.rpartition("=")
+        if not sep or not key:
+            raise ValueError("Invalid %s entry: %r" % (SHARD_MAP, item))
+        shard_map[key] = shard_id
+    return shard_map
+
+
+# NOTE: Model -> (foreign key column, owning model, relationship).
+#       Rows live on the shard of their owner so foreign keys
+#       never cross databases.
+_OWNERS = {
+    models.Network: ("parent_uuid", models.Network, None),
+    models.Subnet: ("network_uuid", models.Network, "network"),
+    models.Port: ("network_uuid", models.Network, "network"),
+    models.TemplateRoute: ("network_uuid", models.Network, None),
+    models.MacPool: ("network_uuid", models.Network, "network"),
+    models.Ip: ("subnet_uuid", models.Subnet, "subnet"),
+    models.Mac: ("pool_uuid", models.MacPool, "pool"),
+    models.MetaIp: ("subnet_uuid", models.Subnet, "subnet"),
+    models.SubnetRoute: ("subnet_uuid", models.Subnet, None),
+    models.Tag: ("association_uuid", models.TagAssociation, "association"),
+}
+
+
+class ShardRouter(object):
+    """Pick shards for a ``ShardedSession``.
+
+    With ``shard_key = tenant_id`` every tenant owned row goes to the shard
+    of its tenant and queries filtering on ``tenant_id`` only visit that
+    shard. Rows of other tenants hanging off a network (child networks,
+    ports) must map to the same shard, pin them in the shard map; writing
+    one that does not raises ``CrossShardError``.
+
+    With ``shard_key = network`` every row follows its owner up to a top
+    level network (or port, route) which is placed by its uuid. Queries
+    visit every shard.
+
+    Keys missing from the shard map are spread by a stable hash.
+    """
+
+    def __init__(self, shard_ids, key="tenant_id", shard_map=None):
+        if key not in SHARD_KEYS:
+            raise ValueError("%s must be one of %s" % (SHARD_KEY,
+                                                       SHARD_KEYS))
+        self.shard_ids = list(shard_ids)
+        self.key = key
+        self.shard_map = shard_map or {}
+        unknown = set(self.shard_map.values()) - set(self.shard_ids)
+        if unknown:
+            raise ValueError("Unknown shards in %s: %s" % (SHARD_MAP,
+                                                           sorted(unknown)))
+
+    def session_kwargs(self, engines):
+        return {"class_": horizontal_shard.ShardedSession,
+                "shards": engines,
+                "shard_chooser": self.shard_chooser,
+                "id_chooser": self.id_chooser,
+                "query_chooser": self.query_chooser}
+
+    def shard_for(self, value):
+        value = str(value)
+        if value in self.shard_map:
+            return self.shard_map[value]
+        index = (zlib.crc32(value) & 0xffffffff) % len(self.shard_ids)
+        return self.shard_ids[index]
+
+    def _owner(self, instance):
+        if isinstance(instance, models.TagAssociation):
+            if instance.discriminator is None:
+                return None
+            return getattr(instance, "%s_parent" % instance.discriminator)
+
+        column, model, relationship = _OWNERS.get(type(instance),
+                                                  (None, None, None))
+        if column is None:
+            return None
+        if relationship is not None:
+            owner = instance.__dict__.get(relationship)
+            if owner is not None:
+                return owner
+
+        uuid = getattr(instance, column)
+        if uuid is None:
+            return None
+        session = sqlalchemy.orm.object_session(instance)
+        if session is None:
+            return None
+        key = sqlalchemy.orm.util.identity_key(model, uuid)
+        owner = session.identity_map.get(key)
+        if owner is None:
+            owner = session.query(model).get(uuid)
+        return owner
+
+    def shard_of(self, instance):
+        """Return the shard ``instance`` was loaded from or belongs on.
+        """
+        shard_id = instance.__dict__.get(_SHARD_ID)
+        if shard_id is not None:
+            return shard_id
+
+        owner = self._owner(instance)
+        if owner is not None:
+            shard_id = self.shard_of(owner)
+
+        tenant = getattr(instance, "tenant_id", None)
+        if self.key == "tenant_id" and tenant is not None:
+            tenant_shard = self.shard_for(tenant)
+            if shard_id is None:
+                shard_id = tenant_shard
+            elif shard_id != tenant_shard:
+                raise CrossShardError(
+                    "%s of tenant %r belongs on shard %r but its owner is "
+                    "on %r, map the tenant to %r in %s" % (
+                        instance.__display_name__, tenant, tenant_shard,
+                        shard_id, shard_id, SHARD_MAP))
+        elif shard_id is None:
+            shard_id = self.shard_for(instance.uuid)
+
+        instance.__dict__[_SHARD_ID] = shard_id
+        return shard_id
+
+    def _before_flush(self, session, flush_context, instances):
+        written = session.__dict__.setdefault(_WRITTEN, set())
+        for instance in session.new | session.deleted:
+            written.add(self.shard_of(instance))
+        for instance in session.dirty:
+            if session.is_modified(instance):
+                written.add(self.shard_of(instance))
+        if len(written) > 1:
+            raise CrossShardError("Transaction writes to shards %s, "
+                                  "without two-phase commit it could "
+                                  "commit partially" % sorted(written))
+
+    def _after_begin(self, session, transaction, connection):
+        session.__dict__.setdefault(_HELD, set()).add(connection.engine)
+
+    def _after_transaction_end(self, session, transaction):
+        if session.transaction is None:
+            session.__dict__.pop(_WRITTEN, None)
+            session.__dict__.pop(_HELD, None)
+
+    def track(self, factory, single_shard_writes=True):
+        """Track the engines ``factory`` sessions hold a connection to in
+        their transaction, see ``fan_out``.
+
+        With ``single_shard_writes`` transactions writing to more than one
+        shard are rejected.
+        """
+        sqlalchemy.event.listen(factory, "after_begin", self._after_begin)
+        sqlalchemy.event.listen(factory, "after_transaction_end",
+                                self._after_transaction_end)
+        if single_shard_writes:
+            sqlalchemy.event.listen(factory, "before_flush",
+                                    self._before_flush)
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        if instance is not None:
+            return self.shard_of(instance)
+        # NOTE: Statements that cannot be routed go to the default
+        #       shard, shard aware callers pass shard_id instead.
+        return self.shard_ids[0]
+
+    def _tenants(self, criterion):
+        """Return tenant ids the criterion requires, or None if any match.
+        """
+        if criterion is None:
+            return None
+        if isinstance(criterion, expression.Grouping):
+            return self._tenants(criterion.element)
+        if (isinstance(criterion, expression.BooleanClauseList) and
+                criterion.operator is operators.and_):
+            for clause in criterion.clauses:
+                tenants = self._tenants(clause)
+                if tenants is not None:
+                    return tenants
+            return None
+        if not isinstance(criterion, expression.BinaryExpression):
+            return None
+
+        left, right = criterion.left, criterion.right
+        if getattr(left, "key", None) != "tenant_id":
+            return None
+        if (criterion.operator is operators.eq and
+                isinstance(right, expression.BindParameter)):
+            return [right.value]
+        if (criterion.operator is operators.in_op and
+                isinstance(right, expression.Grouping)):
+            clauses = getattr(right.element, "clauses", ())
+            if all(isinstance(c, expression.BindParameter)
+                   for c in clauses):
+                return [c.value for c in clauses]
+        return None
+
+    def query_chooser(self, query):
+        tenants = None
+        if self.key == "tenant_id":
+            tenants = self._tenants(query._criterion)
+        if not tenants:
+            return self.shard_ids
+        shard_ids = set(self.shard_for(t) for t in tenants)
+        return [s for s in self.shard_ids if s in shard_ids]
+
+    def id_chooser(self, query, ident):
+        return self.query_chooser(query)
+
+
+def _record_shard(target, context):
+    shard_id = context.attributes.get("shard_id")
+    if shard_id is not None:
+        target.__dict__[_SHARD_ID] = shard_id
+
+
+sqlalchemy.event.listen(sqlalchemy.orm.mapper, "load", _record_shard)
+sqlalchemy.event.listen(sqlalchemy.orm.mapper, "refresh",
+                        lambda target, context, attrs:
+                        _record_shard(target, context))
+
+
+def is_sharded(session):
+    return isinstance(session, horizontal_shard.ShardedSession)
+
+
+def shard_of(instance):
+    """Return the shard id of ``instance``, None if not sharded.
+    """
+    session = sqlalchemy.orm.object_session(instance)
+    if not is_sharded(session):
+        return instance.__dict__.get(_SHARD_ID)
+    return session.shard_chooser(None, instance)
+
+
+def execute(session, statement, params=None, shard_id=None):
+    """``session.execute`` on shard ``shard_id`` when sharded.
+    """
+    if shard_id is None or not is_sharded(session):
+        return session.execute(statement, params)
+    return session.execute(statement, params, shard_id=shard_id)
+
+
+def _run(session, query, shard_id, collecting, results, errors):
+    try:
+        with collecting:
+            results[shard_id] = query.with_session(session).set_shard(
+                shard_id).all()
+    except Exception, ex:
+        errors.append(ex)
+    finally:
+        session.close()
+
+
+def fan_out(request, query, model, limit=None, marker=None):
+    """Return ``query``'s ``model`` rows ordered by uuid, a page at a time.
+
+    Rows after ``marker`` (a uuid) are returned, at most ``limit`` of them.
+    When sharded each shard the query can match is read and the pages are
+    merged. Shards the request transaction already holds a connection to,
+    which includes every shard it wrote to, are read through it so its own
+    writes are seen. The others are read in parallel meanwhile, each in
+    its own thread and session, and see what is committed. Either way a
+    request uses at most one connection per shard.
+    """
+    query = query.order_by(model.uuid)
+    if marker is not None:
+        query = query.filter(model.uuid > marker)
+    if limit is not None:
+        query = query.limit(limit)
+
+    settings = request.registry.settings
+    if not is_sharded(query.session) or DBSESSION_READERS not in settings:
+        return query.all()
+
+    # NOTE: newtonian.instrumentation imports this module.
+    from newtonian import instrumentation
+
+    session = query.session
+    if session.autoflush:
+        session.flush()
+    engines = settings[DBSESSION_SHARDS]
+    held = session.__dict__.get(_HELD, ())
+    shard_ids = query.query_chooser(query)
+    local = [s for s in shard_ids if engines[s] in held]
+
+    readers = settings[DBSESSION_READERS]
+    stats = instrumentation.current(request)
+    results = {}
+    errors = []
+    threads = [threading.Thread(target=_run,
+                                args=(readers(), query, shard_id,
+                                      instrumentation.collecting(stats),
+                                      results, errors))
+               for shard_id in shard_ids if shard_id not in local]
+    for thread in threads:
+        thread.start()
+    try:
+        for shard_id in local:
+            results[shard_id] = query.set_shard(shard_id).all()
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+    rows = [row for shard_id in shard_ids for row in results[shard_id]]
+    rows.sort(key=lambda row: row.uuid)
+    if limit is not None:
+        rows = rows[:limit]
+    return rows
 
 
 class _DBSessionFinder(object):
@@ -135,21 +522,9 @@ class _DBSessionFinder(object):
                 log.warning("Dropped db session due to being inactive")
             session = self.setup_session(request)
 
-        if session is not None:
-            # make sure the new session has the current context
-            # ancestry merged in
-
-            obj = getattr(request, "context", None)
-            for x in range(30):
-                obj = getattr(obj, "__parent__", None)
-
-                if obj is None:
-                    break
-
-                if isinstance(obj, sqlalchemy.ext.declarative.DeclarativeMeta):
-                    log.debug("merged in the context object to active session")
-                    session.merge(obj)
-
+        # NOTE: The traversal resources load their models with
+        #       this same session, so the context ancestry never
+        #       needs to be merged in.
         return session
 
 
@@ -0,0 +1,212 @@
+"""Tenant scoping and quota enforcement.
+
+Every tenant owned model mixes in ``models.IsHazTenant``. Views build their
+queries through ``scoped_query`` so a request carrying a tenant header only
+ever sees (and hits the ``tenant_id`` indexes for) its own rows.
+
+Quota usage is kept as an in memory counter per (tenant, collection),
+loaded with a single COUNT and reloaded once it is older than
+``newtonian.quota_ttl`` seconds. A reservation counts against the quota as
+soon as it is made, so concurrent requests in one process cannot overshoot
+it, and is given back if the surrounding transaction aborts. Other workers
+only see the rows once they reload, so across processes a quota can be
+overshot for at most the TTL. ``quotas.invalidate`` drops the counters
+whenever they can no longer be trusted.
+"""
+import logging
+import threading
+import time
+
+from pyramid import httpexceptions as httpexc
+import sqlalchemy as sa
+import transaction
+
+from newtonian import sqla
+
+
+log = logging.getLogger(__name__)
+
+
+TENANT_HEADER = "newtonian.tenant_header"
+DEFAULT_TENANT_HEADER = "X-Tenant-Id"
+QUOTA_PREFIX = "newtonian.quota."
+QUOTA_TTL = "newtonian.quota_ttl"
+DEFAULT_QUOTA_TTL = 5
+
+
+def tenant_id(request):
+    """Return the tenant the request acts on behalf of, or None.
+    """
+    settings = request.registry.settings
+    header = settings.get(TENANT_HEADER, DEFAULT_TENANT_HEADER)
+    return request.headers.get(header)
+
+
+def is_scoped(model):
+    return hasattr(model, "tenant_id")
+
+
+def scoped_query(request, model):
+    """Return a query for ``model`` limited to the tenant of ``request``.
+
+    Requests without a tenant header (admin tooling) are left unscoped.
+    """
+    query = sqla.dbsession(request).query(model)
+    tenant = tenant_id(request)
+    if tenant is None or not is_scoped(model):
+        return query
+    return query.filter(model.tenant_id == tenant)
+
+
+def apply_tenant(request, values):
+    """Default ``values['tenant_id']`` to the request tenant.
+
+    Raises ``HTTPForbidden`` if the body names a different tenant.
+    """
+    tenant = tenant_id(request)
+    if tenant is None:
+        return values
+    if values.setdefault("tenant_id", tenant) != tenant:
+        raise httpexc.HTTPForbidden(detail="tenant_id does not match "
+                                           "the requesting tenant")
+    return values
+
+
+class _Reservation(object):
+    """Data manager that settles a quota reservation with the transaction.
+    """
+
+    transaction_manager = transaction.manager
+
+    def __init__(self, quotas, key, count):
+        self.quotas = quotas
+        self.key = key
+        self.count = count
+        self._settled = False
+
+    def _settle(self, committed):
+        if not self._settled:
+            self._settled = True
+            self.quotas._settle(self.key, self.count, committed)
+
+    def abort(self, txn):
+        self._settle(False)
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        self._settle(True)
+
+    def tpc_abort(self, txn):
+        self._settle(False)
+
+    def sortKey(self):
+        return "~newtonian.quota:%i" % id(self)
+
+
+class _Quotas(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage = {}
+        self._pending = {}
+
+    def limit(self, request, model):
+        """Return the configured quota for ``model`` or None if unlimited.
+        """
+        key = QUOTA_PREFIX + model.__collection_name__
+        value = request.registry.settings.get(key)
+        if value is None:
+            return None
+        value = int(value)
+        if value < 0:
+            return None
+        return value
+
+    def _load(self, session, tenant, model):
+        query = session.query(sa.func.count(model.uuid))
+        # NOTE: Sum the rows, a sharded session returns a count
+        #       per shard the query visited.
+        return sum(row[0] for row in query.filter(model.tenant_id == tenant))
+
+    def usage(self, session, tenant, model, ttl=DEFAULT_QUOTA_TTL):
+        """Return the committed usage of ``model`` rows by ``tenant``.
+        """
+        key = (tenant, model.__collection_name__)
+        with self._lock:
+            entry = self._usage.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+
+        count = self._load(session, tenant, model)
+        log.debug("quota usage loaded for %s: %i" % (key, count))
+
+        with self._lock:
+            self._usage[key] = (count, time.time() + ttl)
+            return count
+
+    def _settle(self, key, count, committed):
+        with self._lock:
+            self._pending[key] -= count
+            if not self._pending[key]:
+                del self._pending[key]
+            entry = self._usage.get(key)
+            if committed and entry is not None:
+                self._usage[key] = (max(entry[0] + count, 0), entry[1])
+
+    def reserve(self, request, model, count=1, tenant=None):
+        """Reserve ``count`` more ``model`` rows in the tenant quota.
+
+        Raises ``HTTPConflict`` when the quota would be exceeded.
+        """
+        if tenant is None:
+            tenant = tenant_id(request)
+        limit = self.limit(request, model)
+        if tenant is None or limit is None:
+            return
+
+        settings = request.registry.settings
+        ttl = float(settings.get(QUOTA_TTL, DEFAULT_QUOTA_TTL))
+        used = self.usage(sqla.dbsession(request), tenant, model, ttl)
+        key = (tenant, model.__collection_name__)
+        with self._lock:
+            used += self._pending.get(key, 0)
+            if used + count > limit:
+                msg = "Quota exceeded for %s: %i of %i in use"
+                raise httpexc.HTTPConflict(detail=msg % (
+                    model.__collection_name__, used, limit))
+            self._pending[key] = self._pending.get(key, 0) + count
+
+        transaction.get().join(_Reservation(self, key, count))
+
+    def invalidate(self, tenant=None):
+        """Forget cached usage for ``tenant`` (or everyone).
+        """
+        with self._lock:
+            if tenant is None:
+                self._usage.clear()
+                return
+            for key in [k for k in self._usage if k[0] == tenant]:
+                del self._usage[key]
+
+    def _invalidate(self, status, tenants):
+        if status:
+            for tenant in tenants:
+                self.invalidate(tenant)
+
+    def invalidate_on_commit(self, tenants):
+        """Forget cached usage for ``tenants`` once the transaction commits.
+        """
+        if tenants:
+            txn = transaction.get()
+            txn.addAfterCommitHook(self._invalidate, args=(set(tenants),))
+
+
+quotas = _Quotas()
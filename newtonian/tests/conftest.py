@@ -0,0 +1,27 @@
+"""Shared fixtures.
+
+Tests taking ``postgresql_urls`` run against the PostgreSQL databases
+listed (whitespace separated) in ``NEWTONIAN_TEST_POSTGRESQL`` and are
+skipped without it. Every table in those databases is dropped.
+"""
+import os
+
+import pytest
+import sqlalchemy as sa
+
+from newtonian import models
+
+
+POSTGRESQL = "NEWTONIAN_TEST_POSTGRESQL"
+
+
+@pytest.fixture
+def postgresql_urls():
+    urls = os.environ.get(POSTGRESQL, "").split()
+    if not urls:
+        pytest.skip("%s is not set" % POSTGRESQL)
+    for url in urls:
+        engine = sa.create_engine(url)
+        models.Base.metadata.drop_all(engine)
+        engine.dispose()
+    return urls
@@ -0,0 +1,141 @@
+"""Rate limiting buckets, in process and shared through Redis, and the
+concurrency limit.
+"""
+import collections
+
+import pytest
+import sqlalchemy as sa
+
+from newtonian import admission
+from newtonian import sqla
+
+
+RATE = 0.001
+
+
+def test_local_buckets_limit_each_tenant():
+    buckets = admission.LocalBuckets()
+
+    assert buckets.take(("a", "write"), RATE, 2) == 0
+    assert buckets.take(("a", "write"), RATE, 2) == 0
+    assert buckets.take(("a", "write"), RATE, 2) > 0
+    assert buckets.take(("b", "write"), RATE, 2) == 0
+    assert buckets.take(("a", "read"), RATE, 2) == 0
+
+
+def test_rotating_tenants_do_not_reset_a_limit():
+    buckets = admission.LocalBuckets(size=10)
+    buckets.take(("victim", "write"), RATE, 1)
+    assert buckets.take(("victim", "write"), RATE, 1) > 0
+
+    for i in range(100):
+        buckets.take(("spoofed-%i" % i, "write"), RATE, 1)
+
+    assert buckets.take(("victim", "write"), RATE, 1) > 0
+    assert len(buckets._buckets) <= 11
+
+
+def test_new_tenants_share_a_bucket_while_full():
+    buckets = admission.LocalBuckets(size=2)
+    buckets.take(("a", "write"), RATE, 1)
+    buckets.take(("b", "write"), RATE, 1)
+
+    assert buckets.take(("c", "write"), RATE, 1) == 0
+    assert buckets.take(("d", "write"), RATE, 1) > 0
+
+
+def test_refilled_buckets_make_room():
+    buckets = admission.LocalBuckets(size=2)
+    buckets.take(("a", "write"), 1000.0, 1)
+    buckets.take(("b", "write"), RATE, 1)
+    buckets._swept = 0
+
+    buckets._sweep(buckets._buckets[("a", "write")][2])
+
+    assert ("a", "write") not in buckets._buckets
+    assert buckets.take(("c", "write"), RATE, 1) == 0
+    assert ("c", "write") in buckets._buckets
+
+
+class _Script(object):
+    """Stands in for a registered Redis script.
+    """
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = []
+
+    def __call__(self, keys, args):
+        self.calls.append((keys, args))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Client(object):
+
+    def __init__(self, script):
+        self.script = script
+        self.registered = []
+
+    def register_script(self, source):
+        self.registered.append(source)
+        return self.script
+
+
+def test_redis_buckets_call_the_script():
+    script = _Script(result="0.25")
+    client = _Client(script)
+    buckets = admission.RedisBuckets(client, prefix="p:")
+
+    assert buckets.take(("t", "write"), 2.0, 5.0) == 0.25
+    assert client.registered == [admission._TAKE]
+    keys, args = script.calls[0]
+    assert keys == ["p:t:write"]
+    assert args[:2] == [2.0, 5.0] and float(args[2]) > 0
+
+
+def test_redis_errors_let_requests_through():
+    redis = pytest.importorskip("redis")
+    client = _Client(_Script(error=redis.ConnectionError("down")))
+
+    assert admission.RedisBuckets(client).take(("t", "write"), 1, 1) == 0
+
+
+def test_redis_buckets_are_shared_between_workers():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    workers = [admission.RedisBuckets(fakeredis.FakeStrictRedis(server=server))
+               for _ in range(2)]
+
+    assert workers[0].take(("t", "write"), RATE, 2) == 0
+    assert workers[1].take(("t", "write"), RATE, 2) == 0
+    wait = workers[0].take(("t", "write"), RATE, 2)
+    assert wait == pytest.approx(1 / RATE, rel=0.01)
+    assert workers[1].take(("u", "write"), RATE, 2) == 0
+
+
+def _engine(tmpdir, name, **kwargs):
+    return sa.create_engine("sqlite:///%s" % tmpdir.join(name),
+                            poolclass=sa.pool.QueuePool, **kwargs)
+
+
+def test_capacity_of_a_single_pool(tmpdir):
+    engine = _engine(tmpdir, "db", pool_size=5, max_overflow=2)
+    assert admission.capacity({sqla.DBSESSION_ENGINE: engine}) == 7
+
+    engine = _engine(tmpdir, "db", max_overflow=-1)
+    assert admission.capacity({sqla.DBSESSION_ENGINE: engine}) is None
+
+
+def test_capacity_is_the_smallest_shard_pool(tmpdir):
+    shards = collections.OrderedDict([
+        ("a", _engine(tmpdir, "a", pool_size=10, max_overflow=0)),
+        ("b", _engine(tmpdir, "b", pool_size=3, max_overflow=1)),
+        ("c", _engine(tmpdir, "c", max_overflow=-1))])
+    settings = {sqla.DBSESSION_ENGINE: shards["a"],
+                sqla.DBSESSION_SHARDS: shards}
+
+    assert admission.capacity(settings) == 4
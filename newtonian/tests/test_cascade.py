@@ -0,0 +1,97 @@
+"""Network deletes through the full WSGI stack on a single SQLite database.
+"""
+import json
+
+import pytest
+import sqlalchemy as sa
+import transaction
+from webob import Request
+
+import newtonian
+from newtonian import models
+from newtonian import sqla
+
+
+@pytest.fixture
+def app(tmpdir):
+    return newtonian.main({}, **{
+        sqla.SQLALCHEMY_URL: "sqlite:///%s" % tmpdir.join("newtonian.db"),
+        "newtonian.admission": "false"})
+
+
+def _count(app, model):
+    engine = app.registry.settings[sqla.DBSESSION_ENGINE]
+    query = sa.select([sa.func.count()]).select_from(model.__table__)
+    return engine.execute(query).scalar()
+
+
+def _call(app, method, path, body=None, tenant=None):
+    request = Request.blank(path, method=method)
+    if tenant is not None:
+        request.headers["X-Tenant-Id"] = tenant
+    if body is not None:
+        request.body = json.dumps(body)
+        request.content_type = "application/json"
+    return request.get_response(app)
+
+
+def _tree(app, owner, child_tenant):
+    """Create a network of ``owner`` with a subnet, port and IP of
+    ``child_tenant`` under it and return the network and port uuids.
+    """
+    response = _call(app, "POST", "/networks", {"name": "net"},
+                     tenant=owner)
+    network_uuid = json.loads(response.body)["network"]["uuid"]
+
+    factory = app.registry.settings[sqla.DBSESSION_FACTORY]
+    try:
+        with transaction.manager:
+            session = factory()
+            subnet = models.Subnet(network_uuid=network_uuid,
+                                   tenant_id=child_tenant,
+                                   address="10.0.0.0", prefix=24)
+            port = models.Port(network_uuid=network_uuid,
+                               tenant_id=child_tenant, device_id="vm")
+            session.add_all([subnet, port])
+            session.add(models.Ip(subnet=subnet, port=port,
+                                  tenant_id=child_tenant,
+                                  address="10.0.0.10"))
+            session.flush()
+            port_uuid = str(port.uuid)
+    finally:
+        factory.remove()
+    return network_uuid, port_uuid
+
+
+def test_delete_keeps_other_tenants_children(app):
+    network_uuid, port_uuid = _tree(app, "a", "b")
+
+    response = _call(app, "DELETE", "/networks/%s" % network_uuid,
+                     tenant="a")
+
+    assert response.status_int == 409
+    for model in (models.Network, models.Subnet, models.Port, models.Ip):
+        assert _count(app, model) == 1
+    response = _call(app, "GET", "/ports/%s/config" % port_uuid, tenant="b")
+    assert response.status_int == 200
+
+
+def test_delete_own_tree(app):
+    network_uuid, _ = _tree(app, "a", "a")
+
+    response = _call(app, "DELETE", "/networks/%s" % network_uuid,
+                     tenant="a")
+
+    assert response.status_int == 204
+    for model in (models.Network, models.Subnet, models.Port, models.Ip):
+        assert _count(app, model) == 0
+
+
+def test_admin_delete_takes_every_tenants_children(app):
+    network_uuid, _ = _tree(app, "a", "b")
+
+    response = _call(app, "DELETE", "/networks/%s" % network_uuid)
+
+    assert response.status_int == 204
+    for model in (models.Network, models.Subnet, models.Port, models.Ip):
+        assert _count(app, model) == 0
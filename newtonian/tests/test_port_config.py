@@ -0,0 +1,81 @@
+"""Cached port configuration documents seen by several workers.
+"""
+import json
+import uuid
+
+import pytest
+import transaction
+from webob import Request
+
+import newtonian
+from newtonian import models
+from newtonian import port_config
+from newtonian import sqla
+
+
+@pytest.fixture
+def app(tmpdir):
+    return newtonian.main({}, **{
+        sqla.SQLALCHEMY_URL: "sqlite:///%s" % tmpdir.join("newtonian.db"),
+        "newtonian.admission": "false"})
+
+
+def _engine(app):
+    return app.registry.settings[sqla.DBSESSION_ENGINE]
+
+
+def _config(app, port_uuid, etag=None):
+    request = Request.blank("/ports/%s/config" % port_uuid)
+    if etag is not None:
+        request.headers["If-None-Match"] = '"%s"' % etag
+    response = request.get_response(app)
+    body = json.loads(response.body) if response.body else None
+    return response, body
+
+
+def _port(app):
+    factory = app.registry.settings[sqla.DBSESSION_FACTORY]
+    try:
+        with transaction.manager:
+            session = factory()
+            network = models.Network(name="net", tenant_id="t")
+            subnet = models.Subnet(network=network, tenant_id="t",
+                                   address="10.0.0.0", prefix=24)
+            port = models.Port(network=network, tenant_id="t",
+                               device_id="vm")
+            session.add(models.Ip(subnet=subnet, port=port, tenant_id="t",
+                                  address="10.0.0.10"))
+            session.flush()
+            return str(port.uuid), subnet.uuid
+    finally:
+        factory.remove()
+
+
+def _add_dns(app, subnet_uuid):
+    """Change a document's rows the way another process would.
+    """
+    _engine(app).execute(models.MetaIp.__table__.insert().values(
+        uuid=uuid.uuid4(), subnet_uuid=subnet_uuid, ip="10.0.0.2"))
+
+
+def test_commits_bump_the_shared_generation(app):
+    before = port_config.shared_generation(_engine(app))
+    _port(app)
+    assert port_config.shared_generation(_engine(app)) == before + 1
+
+
+def test_bump_drops_documents_cached_by_every_worker(app):
+    port_uuid, subnet_uuid = _port(app)
+    response, body = _config(app, port_uuid)
+    etag = response.etag
+    assert body["port_config"]["ips"][0]["subnet"]["dns"] == []
+
+    _add_dns(app, subnet_uuid)
+    response, _ = _config(app, port_uuid, etag)
+    assert response.status_int == 304
+
+    port_config.bump(_engine(app))
+    response, body = _config(app, port_uuid, etag)
+    assert response.status_int == 200
+    assert response.etag != etag
+    assert body["port_config"]["ips"][0]["subnet"]["dns"] == ["10.0.0.2"]
@@ -0,0 +1,64 @@
+"""Validators and caching headers of compressed and identity responses.
+"""
+import gzip
+import json
+import StringIO
+
+import pytest
+from webob import Request
+
+import newtonian
+from newtonian import sqla
+
+
+@pytest.fixture
+def app(tmpdir):
+    app = newtonian.main({}, **{
+        sqla.SQLALCHEMY_URL: "sqlite:///%s" % tmpdir.join("newtonian.db"),
+        "newtonian.admission": "false"})
+    body = [{"name": "network-%i" % i, "tenant_id": "t"} for i in range(40)]
+    _get(app, "/networks", method="POST", body=json.dumps(body),
+         content_type="application/json")
+    return app
+
+
+def _get(app, path, encoding=None, etag=None, **kwargs):
+    request = Request.blank(path, **kwargs)
+    if encoding is not None:
+        request.headers["Accept-Encoding"] = encoding
+    if etag is not None:
+        request.headers["If-None-Match"] = etag
+    return request.get_response(app)
+
+
+def test_encodings_have_their_own_etag(app):
+    identity = _get(app, "/networks")
+    gzipped = _get(app, "/networks", "gzip")
+
+    assert gzipped.content_encoding == "gzip"
+    assert identity.content_encoding is None
+    assert gzipped.etag == identity.etag + "-gzip"
+    decoded = gzip.GzipFile(fileobj=StringIO.StringIO(gzipped.body)).read()
+    assert decoded == identity.body
+
+
+@pytest.mark.parametrize("held", [None, "gzip"])
+def test_either_etag_revalidates(app, held):
+    etag = _get(app, "/networks", held).headers["ETag"]
+
+    for encoding in (None, "gzip"):
+        response = _get(app, "/networks", encoding, etag)
+        assert response.status_int == 304
+        assert response.body == b""
+        expected = _get(app, "/networks", encoding).etag
+        assert response.etag == expected
+
+    assert _get(app, "/networks", "gzip", '"other-gzip"').status_int == 200
+
+
+def test_small_bodies_vary_on_encoding(app):
+    response = _get(app, "/networks?limit=1", "gzip")
+
+    assert response.content_encoding is None
+    assert "Accept-Encoding" in response.vary
+    assert _get(app, "/networks?limit=1").etag != response.etag
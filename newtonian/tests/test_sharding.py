@@ -0,0 +1,289 @@
+"""Sharding over several databases, through the full WSGI stack.
+
+Every test runs over two SQLite files and, when ``NEWTONIAN_TEST_POSTGRESQL``
+lists at least two databases, over PostgreSQL as well.
+"""
+import contextlib
+import json
+
+import pytest
+import sqlalchemy as sa
+import transaction
+from webob import Request
+
+import newtonian
+from newtonian import models
+from newtonian import sqla
+
+
+SHARD_MAP = "t1=a t2=b t3=a"
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def shard_urls(request, tmpdir):
+    if request.param == "sqlite":
+        return ["sqlite:///%s" % tmpdir.join("%s.db" % shard_id)
+                for shard_id in ("a", "b")]
+    urls = request.getfixturevalue("postgresql_urls")
+    if len(urls) < 2:
+        pytest.skip("sharding needs two PostgreSQL databases")
+    return urls[:2]
+
+
+@pytest.fixture
+def make_app(shard_urls):
+    apps = []
+
+    def make_app(**settings):
+        settings.setdefault(sqla.SHARDS, "a b")
+        settings.setdefault(sqla.SHARD_MAP, SHARD_MAP)
+        settings.setdefault("newtonian.admission", "false")
+        for shard_id, url in zip(("a", "b"), shard_urls):
+            settings[sqla.SHARD_URL % shard_id] = url
+        apps.append(newtonian.main({}, **settings))
+        return apps[-1]
+
+    yield make_app
+    for app in apps:
+        for engine in _engines(app).values():
+            engine.dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+def _engines(app):
+    return app.registry.settings[sqla.DBSESSION_SHARDS]
+
+
+def _count(app, shard_id, model, **filters):
+    table = model.__table__
+    query = sa.select([sa.func.count()]).select_from(table)
+    for name, value in filters.items():
+        query = query.where(table.c[name] == value)
+    return _engines(app)[shard_id].execute(query).scalar()
+
+
+def _call(app, method, path, body=None, tenant=None):
+    request = Request.blank(path, method=method)
+    if tenant is not None:
+        request.headers["X-Tenant-Id"] = tenant
+    if body is not None:
+        request.body = json.dumps(body)
+        request.content_type = "application/json"
+    response = request.get_response(app)
+    payload = json.loads(response.body) if response.body else None
+    return response, payload
+
+
+def _network(app, tenant, name="net"):
+    response, body = _call(app, "POST", "/networks", {"name": name},
+                           tenant=tenant)
+    assert response.status_int == 200, body
+    return body["network"]["uuid"]
+
+
+@contextlib.contextmanager
+def _session(app):
+    factory = app.registry.settings[sqla.DBSESSION_FACTORY]
+    try:
+        with transaction.manager:
+            yield factory()
+    finally:
+        factory.remove()
+
+
+def _subnet(session, network_uuid, tenant, ips=0):
+    subnet = models.Subnet(network_uuid=network_uuid, tenant_id=tenant,
+                           address="10.0.0.0", prefix=24)
+    session.add(subnet)
+    for i in range(ips):
+        session.add(models.Ip(subnet=subnet, tenant_id=tenant,
+                              address="10.0.0.%i" % (i + 10)))
+    session.flush()
+    return subnet.uuid
+
+
+def test_rows_are_placed_by_tenant(app):
+    _network(app, "t1")
+    _network(app, "t2")
+
+    assert _count(app, "a", models.Network, tenant_id="t1") == 1
+    assert _count(app, "b", models.Network, tenant_id="t2") == 1
+    assert _count(app, "a", models.Network) == 1
+    assert _count(app, "b", models.Network) == 1
+
+
+def test_tenant_queries_visit_one_shard(app):
+    with _session(app) as session:
+        query = session.query(models.Network)
+        assert query.query_chooser(query) == ["a", "b"]
+        scoped = query.filter(models.Network.tenant_id == "t2")
+        assert scoped.query_chooser(scoped) == ["b"]
+        both = query.filter(models.Network.tenant_id.in_(["t1", "t2"]))
+        assert both.query_chooser(both) == ["a", "b"]
+
+
+def test_children_follow_their_owner(app):
+    network_uuid = _network(app, "t1")
+    with _session(app) as session:
+        subnet_uuid = _subnet(session, network_uuid, "t3", ips=2)
+
+    assert _count(app, "a", models.Subnet, uuid=subnet_uuid) == 1
+    assert _count(app, "a", models.Ip) == 2
+    assert _count(app, "b", models.Subnet) == 0
+
+
+def test_child_on_another_tenants_shard_is_rejected(app):
+    network_uuid = _network(app, "t1")
+    with pytest.raises(sqla.CrossShardError):
+        with _session(app) as session:
+            session.add(models.Port(network_uuid=network_uuid,
+                                    tenant_id="t2", device_id="vm"))
+            session.flush()
+
+    assert _count(app, "a", models.Port) == 0
+    assert _count(app, "b", models.Port) == 0
+
+
+def test_network_key_keeps_trees_together(make_app):
+    app = make_app(**{sqla.SHARD_KEY: "network", sqla.SHARD_MAP: ""})
+    network_uuid = _network(app, "t1")
+    shard_id = "a" if _count(app, "a", models.Network) else "b"
+
+    with _session(app) as session:
+        _subnet(session, network_uuid, "t2", ips=1)
+
+    assert _count(app, shard_id, models.Subnet, tenant_id="t2") == 1
+    assert _count(app, shard_id, models.Ip, tenant_id="t2") == 1
+
+
+def test_writes_spanning_shards_are_rejected(app):
+    body = [{"name": "one", "tenant_id": "t1"},
+            {"name": "two", "tenant_id": "t2"}]
+    response, payload = _call(app, "POST", "/networks", body)
+
+    assert response.status_int == 409
+    assert "shards" in payload["detail"]
+    assert _count(app, "a", models.Network) == 0
+    assert _count(app, "b", models.Network) == 0
+
+    response, _ = _call(app, "POST", "/networks", body[:1])
+    assert response.status_int == 200
+
+
+def test_fan_out_pages_merge_shards(app):
+    created = [_network(app, tenant, "%s-%i" % (tenant, i))
+               for tenant in ("t1", "t2") for i in range(3)]
+
+    response, page = _call(app, "GET", "/networks?limit=4")
+    first = [n["uuid"] for n in page["networks"]]
+    assert first == sorted(created)[:4]
+
+    href = page["networks_links"][0]["href"].replace("http://localhost", "")
+    response, page = _call(app, "GET", href)
+    second = [n["uuid"] for n in page["networks"]]
+    assert second == sorted(created)[4:]
+    assert "networks_links" not in page
+
+    response, page = _call(app, "GET", "/networks", tenant="t2")
+    assert len(page["networks"]) == 3
+
+
+def _in_use(app):
+    """Track the most connections each shard had checked out at once.
+    """
+    peak = dict((shard_id, 0) for shard_id in _engines(app))
+    current = dict(peak)
+
+    def listen(shard_id, engine):
+        def checkout(*args):
+            current[shard_id] += 1
+            peak[shard_id] = max(peak[shard_id], current[shard_id])
+
+        def checkin(*args):
+            current[shard_id] -= 1
+
+        sa.event.listen(engine.pool, "checkout", checkout)
+        sa.event.listen(engine.pool, "checkin", checkin)
+
+    for shard_id, engine in _engines(app).items():
+        listen(shard_id, engine)
+    return peak
+
+
+def test_fan_out_sees_the_transactions_own_writes(app):
+    _network(app, "t2", "committed")
+    request = Request.blank("/networks")
+    request.registry = app.registry
+    peak = _in_use(app)
+
+    with _session(app) as session:
+        session.add(models.Network(name="pending", tenant_id="t1"))
+        session.flush()
+        rows = sqla.fan_out(request, session.query(models.Network),
+                            models.Network)
+        names = sorted(network.name for network in rows)
+        transaction.abort()
+
+    assert names == ["committed", "pending"]
+    assert peak == {"a": 1, "b": 1}
+    assert _count(app, "a", models.Network) == 0
+
+
+def test_fan_out_queries_are_instrumented(app):
+    _network(app, "t1")
+    _network(app, "t2")
+
+    response, _ = _call(app, "GET", "/networks")
+
+    assert int(response.headers["X-Newtonian-Db-Queries"]) >= 2
+    db = response.headers["Server-Timing"].split(",")[0]
+    assert db.startswith("db;dur=") and float(db[7:]) > 0
+
+
+def test_cascade_delete_runs_on_the_owning_shard(app):
+    keep = _network(app, "t1")
+    network_uuid = _network(app, "t2")
+    with _session(app) as session:
+        subnet_uuid = _subnet(session, network_uuid, "t2")
+        pool = models.MacPool(network_uuid=network_uuid,
+                              address="02:00:00:00:00:00", prefix=24)
+        port = models.Port(network_uuid=network_uuid, tenant_id="t2",
+                           device_id="vm")
+        session.add_all([pool, port])
+        session.flush()
+        session.add(models.Ip(subnet_uuid=subnet_uuid, port=port,
+                              tenant_id="t2", address="10.0.0.10"))
+        session.add(models.Mac(pool=pool, port=port,
+                               address="02:00:00:00:00:01"))
+
+    response, _ = _call(app, "DELETE", "/networks/%s" % network_uuid,
+                        tenant="t2")
+
+    assert response.status_int == 204
+    for model in (models.Network, models.Subnet, models.Port, models.Ip,
+                  models.MacPool, models.Mac):
+        assert _count(app, "b", model) == 0
+    assert _count(app, "a", models.Network, uuid=keep) == 1
+
+
+def test_counters_are_kept_on_the_shard(app):
+    network_uuid = _network(app, "t2")
+    with _session(app) as session:
+        subnet_uuid = _subnet(session, network_uuid, "t2", ips=3)
+
+    used = sa.select([models.Subnet.__table__.c.used_ips])
+    assert _engines(app)["b"].execute(used).scalar() == 3
+
+    with _session(app) as session:
+        ip = session.query(models.Ip).filter(
+            models.Ip.subnet_uuid == subnet_uuid,
+            models.Ip.tenant_id == "t2").first()
+        ip.deallocate()
+
+    assert _engines(app)["b"].execute(used).scalar() == 2
+    response, body = _call(app, "GET", "/stats/subnets", tenant="t2")
+    assert [s["used"] for s in body["subnets"]] == [2]
@@ -0,0 +1,92 @@
+"""Export and import round trips, across dialects when PostgreSQL is set up.
+"""
+import cStringIO
+import datetime
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from newtonian import models
+from newtonian.scripts import transfer
+
+
+_MODELS = (models.Network, models.Subnet, models.MetaIp, models.SubnetRoute,
+           models.Port, models.Ip, models.MacPool, models.Mac)
+
+
+def _seed(engine):
+    models.Base.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine)()
+    network = models.Network(name="net", tenant_id="t",
+                             state=models.NetworkState.up)
+    child = models.Network(name="child", tenant_id="t")
+    network.children.append(child)
+    v4 = models.Subnet(network=network, tenant_id="t", address="10.0.0.0",
+                       prefix=24)
+    v6 = models.Subnet(network=network, tenant_id="t", address="fd00::",
+                       prefix=64)
+    pool = models.MacPool(network=network, address="02:00:00:00:00:00",
+                          prefix=24)
+    port = models.Port(network=network, tenant_id="t", device_id="vm",
+                       state=models.PortState.up)
+    session.add_all([
+        models.MetaIp(subnet=v4, ip="10.0.0.2"),
+        models.SubnetRoute(subnet=v4, address="0.0.0.0", prefix=0,
+                           next_hop="10.0.0.1"),
+        models.Ip(subnet=v4, port=port, tenant_id="t", address="10.0.0.10"),
+        models.Ip(subnet=v6, port=port, tenant_id="t", address="fd00::a",
+                  deallocated_at=datetime.datetime(2014, 1, 2, 3, 4, 5)),
+        models.Mac(network=network, pool=pool, port=port,
+                   address="02:00:00:0a:0b:0c")])
+    session.commit()
+    session.close()
+
+
+def _dump(engine):
+    session = orm.sessionmaker(bind=engine)()
+    try:
+        return dict((model.__collection_name__,
+                     sorted((obj.dictify() for obj in session.query(model)),
+                            key=lambda d: d["uuid"]))
+                    for model in _MODELS)
+    finally:
+        session.close()
+
+
+def _round_trip(source, target):
+    _seed(source)
+    stream = cStringIO.StringIO()
+    transfer.export(source, transfer._JSONWriter(stream))
+    stream.seek(0)
+
+    models.Base.metadata.create_all(target)
+    transfer.load(target, transfer._read_json(stream, 0))
+    return _dump(source), _dump(target), stream.getvalue()
+
+
+def _sqlite(tmpdir, name):
+    return sa.create_engine("sqlite:///%s" % tmpdir.join(name))
+
+
+def test_round_trip(tmpdir):
+    exported, imported, snapshot = _round_trip(_sqlite(tmpdir, "source.db"),
+                                               _sqlite(tmpdir, "target.db"))
+    assert imported == exported
+    assert sorted(ip["address"] for ip in imported["ips"]) == [
+        "10.0.0.10", "fd00::a"]
+    assert '"10.0.0.10"' in snapshot and "::ffff:" not in snapshot
+
+
+@pytest.mark.parametrize("direction", ["to_postgresql", "from_postgresql"])
+def test_round_trip_across_dialects(tmpdir, postgresql_urls, direction):
+    sqlite = _sqlite(tmpdir, "newtonian.db")
+    postgresql = sa.create_engine(postgresql_urls[0])
+    source, target = sqlite, postgresql
+    if direction == "from_postgresql":
+        source, target = postgresql, sqlite
+    try:
+        exported, imported, _ = _round_trip(source, target)
+    finally:
+        postgresql.dispose()
+    assert imported == exported
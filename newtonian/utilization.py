@@ -0,0 +1,191 @@
+"""Subnet and MAC pool utilization.
+
+``Subnet.used_ips`` and ``MacPool.used_macs`` count the live (not
+deallocated) rows in each subnet and pool. They are maintained
+incrementally: every flush that creates, deallocates, re-allocates, moves
+or deletes an ``Ip`` or ``Mac`` adds its net change with one
+``UPDATE ... SET used = used + :delta`` per touched subnet or pool, inside
+the same transaction. Reading utilization is then a single query over
+``subnets`` or ``mac_pools`` no matter how many addresses are allocated.
+
+Bulk statements that bypass the session (``newtonian.cascade``, imports,
+raw SQL) either adjust the counters themselves or leave them to
+``reconcile``, which recounts and fixes any drift in one statement per
+table. ``newtonian_reconcile`` runs it periodically.
+"""
+import collections
+import logging
+
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from newtonian import models
+from newtonian import sqla
+from newtonian import tenancy
+
+
+log = logging.getLogger(__name__)
+
+
+# NOTE: Model -> (column grouping it, counter table, counter)
+_COUNTED = {
+    models.Ip: ("subnet_uuid", models.Subnet.__table__, "used_ips"),
+    models.Mac: ("pool_uuid", models.MacPool.__table__, "used_macs"),
+}
+
+_BITS = {4: 32, 6: 128}
+_MAC_BITS = 48
+
+
+def _values(obj, attr):
+    """Return the (committed, current) values of ``attr`` on ``obj``.
+    """
+    history = orm.attributes.get_history(obj, attr)
+    if not history.has_changes():
+        value = history.unchanged[0] if history.unchanged else None
+        return value, value
+    old = history.deleted[0] if history.deleted else None
+    new = history.added[0] if history.added else None
+    return old, new
+
+
+def _deltas(session):
+    deltas = collections.defaultdict(int)
+
+    for obj in session.new:
+        if type(obj) in _COUNTED and obj.deallocated_at is None:
+            column = _COUNTED[type(obj)][0]
+            shard_id = sqla.shard_of(obj)
+            deltas[type(obj), getattr(obj, column), shard_id] += 1
+
+    for obj in session.dirty:
+        if type(obj) not in _COUNTED:
+            continue
+        column = _COUNTED[type(obj)][0]
+        old_group, new_group = _values(obj, column)
+        old_freed, new_freed = _values(obj, "deallocated_at")
+        shard_id = sqla.shard_of(obj)
+        if old_freed is None:
+            deltas[type(obj), old_group, shard_id] -= 1
+        if new_freed is None:
+            deltas[type(obj), new_group, shard_id] += 1
+
+    for obj in session.deleted:
+        if type(obj) not in _COUNTED:
+            continue
+        column = _COUNTED[type(obj)][0]
+        old_group, _ = _values(obj, column)
+        old_freed, _ = _values(obj, "deallocated_at")
+        if old_freed is None:
+            deltas[type(obj), old_group, sqla.shard_of(obj)] -= 1
+
+    return dict((key, delta) for key, delta in deltas.iteritems()
+                if delta and key[1] is not None)
+
+
+def _after_flush(session, flush_context):
+    deltas = _deltas(session)
+    if not deltas:
+        return
+
+    statements = {}
+    for (model, group, shard_id), delta in deltas.iteritems():
+        _, table, counter = _COUNTED[model]
+        if (model, shard_id) not in statements:
+            statement = (table.update()
+                         .where(table.c.uuid == sa.bindparam("group"))
+                         .values({counter: table.c[counter] +
+                                  sa.bindparam("delta")}))
+            statements[model, shard_id] = (statement, [])
+        statements[model, shard_id][1].append({"group": group,
+                                               "delta": delta})
+
+    for (_, shard_id), (statement, params) in statements.iteritems():
+        sqla.execute(session, statement, params, shard_id)
+
+
+def _live(model, table):
+    column, _, _ = _COUNTED[model]
+    counted = model.__table__
+    query = sa.select([sa.func.count(counted.c.uuid)])
+    query = query.where(sa.and_(counted.c[column] == table.c.uuid,
+                                counted.c.deallocated_at == None))
+    return query.as_scalar()
+
+
+def reconcile(connectable):
+    """Recount every counter and fix the ones that drifted.
+
+    ``connectable`` is a session, connection or engine. Returns a dict of
+    table name to number of rows corrected.
+    """
+    fixed = {}
+    for model, (_, table, counter) in _COUNTED.iteritems():
+        live = _live(model, table)
+        statement = table.update().where(table.c[counter] != live)
+        result = connectable.execute(statement.values({counter: live}))
+        fixed[table.name] = result.rowcount
+        if result.rowcount:
+            log.warning("corrected %i drifted %s.%s counters" %
+                        (result.rowcount, table.name, counter))
+    return fixed
+
+
+def subnets(request):
+    """Utilization of every subnet visible to the request, in one query.
+    """
+    Subnet = models.Subnet
+    query = tenancy.scoped_query(request, Subnet).with_entities(
+        Subnet.uuid, Subnet.network_uuid, Subnet.tenant_id, Subnet.address,
+        Subnet.prefix, Subnet.used_ips)
+
+    stats = []
+    for uuid, network_uuid, tenant_id, address, prefix, used in query:
+        size = 2 ** (_BITS[address.version] - prefix)
+        stats.append({"uuid": str(uuid),
+                      "network_uuid": str(network_uuid),
+                      "tenant_id": tenant_id,
+                      "cidr": "%s/%i" % (address, prefix),
+                      "size": size,
+                      "used": used,
+                      "free": size - used})
+    return stats
+
+
+def mac_pools(request):
+    """Utilization of every MAC pool visible to the request, in one query.
+    """
+    MacPool = models.MacPool
+    query = tenancy.scoped_query(request, MacPool).with_entities(
+        MacPool.uuid, MacPool.network_uuid, MacPool.address, MacPool.prefix,
+        MacPool.used_macs)
+
+    # NOTE: Pools carry no tenant of their own, scope them by the
+    #       network they belong to.
+    tenant = tenancy.tenant_id(request)
+    if tenant is not None:
+        query = query.join(models.Network,
+                           MacPool.network_uuid == models.Network.uuid)
+        query = query.filter(models.Network.tenant_id == tenant)
+
+    stats = []
+    for uuid, network_uuid, address, prefix, used in query:
+        size = 2 ** (_MAC_BITS - prefix)
+        stats.append({"uuid": str(uuid),
+                      "network_uuid": network_uuid and str(network_uuid),
+                      "cidr": "%s/%i" % (address, prefix),
+                      "size": size,
+                      "used": used,
+                      "free": size - used})
+    return stats
+
+
+_listening = False
+
+
+def includeme(config):
+    global _listening
+
+    if not _listening:
+        sa.event.listen(orm.Session, "after_flush", _after_flush)
+        _listening = True
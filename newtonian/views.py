@@ -1,27 +1,52 @@
+import urllib
+import uuid
+
 import cornice
 from pyramid import httpexceptions as httpexc
-from pyramid import view
 
+from newtonian import cascade
+from newtonian import instrumentation
 from newtonian import models
+from newtonian import port_config
+from newtonian import resources
 from newtonian import sqla
+from newtonian import tenancy
+from newtonian import utilization
 
 
-@view.view_config(context=httpexc.WSGIHTTPException)
 def _format_exception(exc, request):
-    request.response_status = exc.status
+    request.response.status = exc.status
     return {'code': exc.code, 'title': exc.title,
             'explanation': exc.explanation, 'detail': exc.detail}
 
 
+def _format_cross_shard(exc, request):
+    return _format_exception(httpexc.HTTPConflict(detail=str(exc)), request)
+
+
 def _get_session(request):
     return sqla.dbsession(request)
 
 
+def _query(request, model):
+    return tenancy.scoped_query(request, model)
+
+
+def _reserve(request, model, objs):
+    counts = {}
+    for obj in objs:
+        counts[obj.tenant_id] = counts.get(obj.tenant_id, 0) + 1
+    for tenant, count in counts.iteritems():
+        tenancy.quotas.reserve(request, model, count, tenant)
+
+
 def _resource(name, collection_name=None):
     if collection_name is None:
         collection_name = name + 's'
-    c = cornice.Service(name=collection_name, path='/%s' % collection_name)
-    r = cornice.Service(name=name, path='/%s/{uuid}' % collection_name)
+    c = cornice.Service(name=collection_name, path='/%s' % collection_name,
+                        renderer='newtonian')
+    r = cornice.Service(name=name, path='/%s/{uuid}' % collection_name,
+                        renderer='newtonian')
     return c, r
 
 
@@ -30,33 +55,69 @@ ports, port = _resource('port')
 subnets, subnet = _resource('subnet')
 routes, route = _resource('route')
 ips, ip = _resource('ip')
+port_configs = cornice.Service(name='port_config',
+                               path='/ports/{uuid}/config',
+                               renderer='newtonian')
+subnet_stats = cornice.Service(name='subnet_stats', path='/stats/subnets',
+                               renderer='newtonian')
+mac_pool_stats = cornice.Service(name='mac_pool_stats',
+                                 path='/stats/mac_pools',
+                                 renderer='newtonian')
 
 
-def _object(obj, collection=False):
-    value = obj.dictify()
+def _object(obj, collection=False, request=None):
     if collection:
-        return value
-    return {obj.__display_name__: value}
-
-
-def _collection(col, model):
-    return {model.__collection_name__: [_object(obj, col) for obj in col]}
-
-
-def _get_network(uuid, session):
-    query = session.query(models.Network)
-    network = query.filter_by(uuid=uuid).first()
-    if not network:
+        return obj.dictify()
+
+    instrumentation.count_items(request, 1)
+    with instrumentation.timed(request, "serialize"):
+        return {obj.__display_name__: obj.dictify()}
+
+
+def _collection(col, model, request=None):
+    instrumentation.count_items(request, len(col))
+    with instrumentation.timed(request, "serialize"):
+        return {model.__collection_name__: [_object(obj, col)
+                                            for obj in col]}
+
+
+def _page(request, query, model):
+    """Render a page of ``query`` selected by the ``limit`` and ``marker``
+    parameters, read from every shard it can match.
+    """
+    try:
+        limit = request.GET.get('limit')
+        if limit is not None:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError(limit)
+        marker = request.GET.get('marker')
+        if marker is not None:
+            marker = uuid.UUID(marker)
+    except ValueError:
+        raise httpexc.HTTPBadRequest(detail='Invalid limit or marker')
+
+    rows = sqla.fan_out(request, query, model, limit, marker)
+    result = _collection(rows, model, request)
+    if limit is not None and len(rows) == limit:
+        params = dict(request.GET, marker=str(rows[-1].uuid))
+        href = '%s?%s' % (request.path_url, urllib.urlencode(params))
+        result[model.__collection_name__ + '_links'] = [{'rel': 'next',
+                                                          'href': href}]
+    return result
+
+
+def _get_network(request, uuid):
+    try:
+        return request.root['networks'][uuid].model
+    except KeyError:
         raise httpexc.HTTPNotFound()
-    return network
 
 
 @networks.get()
 def get_networks(request):
-    session = _get_session(request)
-
-    query = session.query(models.Network)
-    return _collection(query.all(), models.Network)
+    query = _query(request, models.Network)
+    return _page(request, query, models.Network)
 
 
 @networks.post()
@@ -64,30 +125,99 @@ def create_network(request):
     session = _get_session(request)
     body = request.json_body
     if 'networks' in body:
-        networks = [models.Network(**n) for n in body['networks']]
-    elif isinstance(body, list):
-        networks = [models.Network(**n) for n in body]
-    else:
-        networks = [models.Network(**body)]
+        body = body['networks']
+    elif not isinstance(body, list):
+        body = [body]
+    networks = [models.Network(**tenancy.apply_tenant(request, n))
+                for n in body]
+    _reserve(request, models.Network, networks)
     session.add_all(networks)
     session.flush()
     if len(networks) == 1:
-        return _object(networks[0])
-    return _collection(networks, models.Network)
+        return _object(networks[0], request=request)
+    return _collection(networks, models.Network, request)
 
 
 @network.get()
 def get_network(request):
     uuid = request.matchdict['uuid']
-    session = _get_session(request)
-    network = _get_network(uuid, session)
-    return _object(network)
+    network = _get_network(request, uuid)
+    return _object(network, request=request)
 
 
 @network.delete()
 def delete_network(request):
     uuid = request.matchdict['uuid']
     session = _get_session(request)
-    network = _get_network(uuid, session)
-    session.delete(network)
+    network = _get_network(request, uuid)
+    shard_id = sqla.shard_of(network)
+    # NOTE: Children, ports and IPs may belong to other tenants. Only
+    #       admin requests may take those down with the network, the
+    #       cached usage of every tenant that loses rows is reloaded.
+    tenants = cascade.owners(session, [network.uuid], shard_id)
+    tenant = tenancy.tenant_id(request)
+    if tenant is not None and tenants - set([tenant]):
+        raise httpexc.HTTPConflict(detail='Network has resources of '
+                                          'other tenants')
+    cascade.delete_networks(session, [network.uuid], shard_id)
+    session.expunge(network)
+    port_config.invalidate_on_commit(session)
+    tenancy.quotas.invalidate_on_commit(tenants)
     return httpexc.HTTPNoContent()
+
+
+@port_configs.get()
+def get_port_config(request):
+    session = _get_session(request)
+    try:
+        document, etag = port_config.lookup(session,
+                                            request.matchdict['uuid'])
+    except ValueError:
+        document = None
+
+    tenant = tenancy.tenant_id(request)
+    if document is None or tenant not in (None, document['tenant_id']):
+        raise httpexc.HTTPNotFound()
+    # NOTE: Lets the renderer answer If-None-Match and reuse the
+    #       encoded body without serializing the document again.
+    request.response.etag = etag
+    return {'port_config': document}
+
+
+@subnet_stats.get()
+def get_subnet_stats(request):
+    stats = utilization.subnets(request)
+    instrumentation.count_items(request, len(stats))
+    return {'subnets': stats}
+
+
+@mac_pool_stats.get()
+def get_mac_pool_stats(request):
+    stats = utilization.mac_pools(request)
+    instrumentation.count_items(request, len(stats))
+    return {'mac_pools': stats}
+
+
+def _item(context, request):
+    return _object(context.model, request=request)
+
+
+def _items(context, request):
+    return _page(request, context.query(), context.model)
+
+
+def includeme(config):
+    """Register the views explicitly rather than through a venusian scan.
+    """
+    config.add_view(_format_exception, context=httpexc.WSGIHTTPException,
+                    renderer='newtonian')
+    config.add_view(_format_cross_shard, context=sqla.CrossShardError,
+                    renderer='newtonian')
+    config.add_view(_item, context=resources.Item, request_method='GET',
+                    renderer='newtonian')
+    config.add_view(_items, context=resources.Collection,
+                    request_method='GET', renderer='newtonian')
+    for service in (networks, network, ports, port, subnets, subnet,
+                    routes, route, ips, ip, port_configs, subnet_stats,
+                    mac_pool_stats):
+        config.add_cornice_service(service)
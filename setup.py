@@ -35,9 +35,17 @@ setup(name="newtonian",
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    tests_require=["pytest", "fakeredis[lua]"],
+    extras_require={"msgpack": ["msgpack-python"],
+                    "redis": ["redis"],
+                    "zstd": ["zstandard"]},
     entry_points="""\
     [paste.app_factory]
     main = newtonian:main
+    [console_scripts]
+    newtonian_export = newtonian.scripts.transfer:export_main
+    newtonian_import = newtonian.scripts.transfer:import_main
+    newtonian_reconcile = newtonian.scripts.reconcile:main
     """,
     paster_plugins=["pyramid"],
 )